@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# Benchmark of reading SGF files in archives ("ARCHIVE!MEMBER" in sgfFile
+# and -input-archive) compared with extracted files. Tiny random SGF files
+# are written into a temporary directory, a zip, and compressed tars.
+#   extracted:          read extracted files (extraction is not counted)
+#   extract + read:     extract the archive and then read the files
+#   members:            read members directly from the archive
+#
+# (ex.)
+# ./bench_archive.py
+# ./bench_archive.py -files 100000
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+import katawrap
+import archive
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark reading SGF files in archives.')
+    parser.add_argument('-files', metavar='N', type=int, help='number of SGF files', default=20000)
+    parser.add_argument('-moves', metavar='N', type=int, help='moves in each SGF', default=200)
+    parser.add_argument('-seed', metavar='N', type=int, help='random seed', default=1)
+    args = vars(parser.parse_args())
+
+##############################################
+# data
+
+def random_sgf(moves):
+    letters = 'abcdefghijklmnopqrs'
+    nodes = ''.join(f";{'BW'[k % 2]}[{random.choice(letters)}{random.choice(letters)}]" for k in range(moves))
+    return f"(;GM[1]FF[4]SZ[19]KM[6.5]RU[japanese]{nodes})"
+
+def prepare(tmp):
+    extracted = os.path.join(tmp, 'extracted')
+    names = [f"games/{k // 1000:03d}/{k:06d}.sgf" for k in range(args['files'])]
+    for name in names:
+        path = os.path.join(extracted, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(random_sgf(args['moves']))
+    archives = {}
+    archives['zip'] = os.path.join(tmp, 'games.zip')
+    with zipfile.ZipFile(archives['zip'], 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for name in names:
+            z.write(os.path.join(extracted, name), name)
+    for ext, mode in [('tar.gz', 'w:gz'), ('tar.xz', 'w:xz')]:
+        archives[ext] = os.path.join(tmp, f"games.{ext}")
+        with tarfile.open(archives[ext], mode) as t:
+            for name in names:
+                t.add(os.path.join(extracted, name), name)
+    return extracted, names, archives
+
+##############################################
+# measure
+
+def read_all(paths):
+    return sum(len(katawrap.read_sgf_file(p)) for p in paths)
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def extract_and_read(path, tmp):
+    dest = os.path.join(tmp, 'extracted_again')
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as z:
+            z.extractall(dest)
+    else:
+        with tarfile.open(path) as t:
+            t.extractall(dest, filter='data')
+    paths = [os.path.join(root, f) for root, _, files in os.walk(dest) for f in files]
+    read_all(paths)
+    shutil.rmtree(dest)
+
+def read_members(path):
+    read_all(archive.member_paths(path))
+    archive.close_all()
+
+def report(label, seconds):
+    print(f"  {label:16} {args['files'] / seconds:9.0f} files/s ({seconds:.2f} s)", flush=True)
+
+##############################################
+# main
+
+def main():
+    random.seed(args['seed'])
+    with tempfile.TemporaryDirectory() as tmp:
+        extracted, names, archives = prepare(tmp)
+        print(f"{args['files']} files")
+        report('extracted', timed(lambda: read_all(os.path.join(extracted, n) for n in names)))
+        for ext, path in archives.items():
+            print(f"{ext} ({os.path.getsize(path) / 1024**2:.1f} MB)")
+            report('extract + read', timed(lambda: extract_and_read(path, tmp)))
+            report('members', timed(lambda: read_members(path)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# Benchmark of -output PATH.gz (katawrap/block_gzip.py) compared with
+# piping the same lines through the gzip command and with the gzip module.
+#   block gzip:     BlockGzipWriter (members compressed in a thread pool)
+#   gzip module:    gzip.open(PATH, 'wt') in the writing thread
+#   pipe to gzip:   katawrap ... | gzip > PATH
+# Lines of ../sample/sample_result.jsonl (or the given file) are repeated
+# up to -mb megabytes and written one by one as katawrap does.
+#
+# (ex.)
+# ./bench_gzip.py
+# ./bench_gzip.py -mb 300 -threads 4
+
+import argparse
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+from block_gzip import BlockGzipWriter
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark gzip output of katawrap.')
+    parser.add_argument('file', metavar='FILE', nargs='?', help='JSONL file', default=os.path.join(here, '..', 'sample', 'sample_result.jsonl'))
+    parser.add_argument('-mb', metavar='MB', type=float, help='total size of written lines', default=100)
+    parser.add_argument('-threads', metavar='N', type=int, help='threads for BlockGzipWriter (default: as katawrap)', default=None)
+    parser.add_argument('-level', metavar='N', type=int, help='compression level (gzip command: -N)', default=6)
+    args = vars(parser.parse_args())
+
+##############################################
+# data
+
+def read_lines(path, mb):
+    with open(path, encoding='utf-8') as f:
+        lines = [line if line.endswith('\n') else line + '\n' for line in f if line.strip()]
+    size = sum(len(line.encode()) for line in lines)
+    repeat = max(1, round(mb * 1024**2 / size))
+    return lines * repeat
+
+##############################################
+# measure
+
+def write_block_gzip(lines, path):
+    writer = BlockGzipWriter(path, threads=args['threads'], compresslevel=args['level'])
+    for line in lines:
+        writer.write(line)
+    writer.close()
+
+def write_gzip_module(lines, path):
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=args['level']) as f:
+        for line in lines:
+            f.write(line)
+
+def write_pipe(lines, path):
+    with open(path, 'wb') as out:
+        proc = subprocess.Popen(['gzip', '-c', f"-{args['level']}"], stdin=subprocess.PIPE, stdout=out)
+        for line in lines:
+            proc.stdin.write(line.encode())
+        proc.stdin.close()
+        proc.wait()
+
+def measure(write, lines, path):
+    start = time.perf_counter()
+    cpu = time.process_time()
+    write(lines, path)
+    return time.perf_counter() - start, time.process_time() - cpu
+
+def is_same(lines, path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return f.read() == ''.join(lines)
+
+##############################################
+# main
+
+def main():
+    lines = read_lines(args['file'], args['mb'])
+    mb = sum(len(line.encode()) for line in lines) / 1024**2
+    methods = [('block gzip', write_block_gzip), ('gzip module', write_gzip_module)]
+    if shutil.which('gzip'):
+        methods.append(('pipe to gzip', write_pipe))
+    else:
+        print('(gzip command is not found)')
+    print(f"{len(lines)} lines, {mb:.1f} MB, {os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, write in methods:
+            path = os.path.join(tmp, 'output.jsonl.gz')
+            seconds, cpu = measure(write, lines, path)
+            compressed = os.path.getsize(path) / 1024**2
+            same = 'yes' if is_same(lines, path) else 'NO'
+            print(
+                f"  {label:13} {mb / seconds:7.1f} MB/s ({seconds:.2f} s, CPU of this process {cpu:.2f} s)"
+                f"  {compressed:.1f} MB  same: {same}",
+                flush=True,
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# Benchmark of the directory walk for -input-dir (katawrap/dir_walk.py)
+# against serial os.walk, without and with hashing files for -dedup.
+# Tiny SGF files are written into a temporary directory tree.
+# Give -latency to emulate slow storage (e.g. network file systems)
+# by sleeping before each read.
+#
+# (ex.)
+# ./bench_input_dir.py
+# ./bench_input_dir.py -latency 0.001
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+import dir_walk
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the directory walk for -input-dir.')
+    parser.add_argument('-dirs', metavar='N', type=int, help='number of directories', default=200)
+    parser.add_argument('-files', metavar='N', type=int, help='number of SGF files in each directory', default=100)
+    parser.add_argument('-latency', metavar='SEC', type=float, help='sleep SEC before each read', default=0)
+    parser.add_argument('-seed', metavar='N', type=int, help='random seed', default=1)
+    args = vars(parser.parse_args())
+
+##############################################
+# data
+
+def prepare(top):
+    for d in range(args['dirs']):
+        path = os.path.join(top, f"{d % 10}", f"{d}")
+        os.makedirs(path)
+        for k in range(args['files']):
+            with open(os.path.join(path, f"{k}.sgf"), 'w') as f:
+                f.write('(;SZ[19]' + ';B[aa];W[bb]' * random.randint(50, 150) + ')')
+
+##############################################
+# measure
+
+def read(path):
+    if args['latency']:
+        time.sleep(args['latency'])
+    with open(path, 'rb') as f:
+        return f.read()
+
+def serial_walk(top, read):
+    ret = []
+    for root, _, files in os.walk(top):
+        for name in files:
+            if name.lower().endswith('.sgf'):
+                path = os.path.join(root, name)
+                ret.append((path, None if read is None else dir_walk.digest_of(path, read)))
+    return ret
+
+def parallel_walk(top, read):
+    return list(dir_walk.walk_files(top, ('.sgf',), read))
+
+def report(label, walk, top, read):
+    start = time.perf_counter()
+    found = walk(top, read)
+    seconds = time.perf_counter() - start
+    print(f"  {label:10} {len(found) / seconds:9.0f} files/s ({seconds:.2f} s)", flush=True)
+
+##############################################
+# main
+
+def main():
+    random.seed(args['seed'])
+    with tempfile.TemporaryDirectory() as top:
+        prepare(top)
+        print(f"{args['dirs'] * args['files']} files in {args['dirs']} directories")
+        for title, r in [('list', None), ('list + hash', read)]:
+            print(title)
+            report('os.walk', serial_walk, top, r)
+            report('dir_walk', parallel_walk, top, r)
+
+if __name__ == "__main__":
+    main()
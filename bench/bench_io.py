@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# Microbenchmark of the line I/O of katawrap (batched_io.py) through
+# pipes. It compares per-line readline/flush (as -line-buffered) with
+# LineReader and BatchedWriter without KataGo or Sorter.
+#
+# (ex.)
+# ./bench_io.py -lines 200000
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+from batched_io import LineReader, BatchedWriter
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark line I/O of katawrap through pipes.')
+    parser.add_argument('-lines', metavar='N', type=int, help='number of lines', default=100000)
+    parser.add_argument('-move-infos', metavar='N', type=int, help='length of moveInfos in each response', default=2)
+    args = vars(parser.parse_args())
+
+##############################################
+# data
+
+def response_line(k, move_infos):
+    # shaped like a response for maxVisits=1
+    return json.dumps({
+        'id': f"{k // 50:016x}",
+        'turnNumber': k % 50,
+        'isDuringSearch': False,
+        'moveInfos': [
+            {'move': 'Q16', 'order': j, 'visits': 1, 'winrate': 0.5, 'scoreLead': 0.1, 'prior': 0.1, 'pv': ['Q16']}
+            for j in range(move_infos)
+        ],
+        'rootInfo': {'currentPlayer': 'B', 'visits': 1, 'winrate': 0.5, 'scoreLead': 0.1},
+    })
+
+def query_line(k):
+    return json.dumps({'id': f"{k:016x}", 'moves': [['B', 'Q16']], 'rules': 'japanese', 'komi': 6.5,
+                       'boardXSize': 19, 'boardYSize': 19, 'analyzeTurns': [1], 'maxVisits': 1})
+
+##############################################
+# cases
+
+def sink():
+    return subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+def read_and_write(path, batched):
+    # KataGo stdout ==> katawrap stdout
+    source = subprocess.Popen(['cat', path], stdout=subprocess.PIPE)
+    output = sink()
+    if batched:
+        reader, writer = LineReader(source.stdout), BatchedWriter(output.stdin)
+        read_line = reader.readline
+    else:
+        writer = output.stdin
+        read_line = lambda: source.stdout.readline().decode().strip()
+    count = 0
+    while True:
+        line = read_line()
+        if not line:
+            break
+        writer.write((line + '\n').encode())
+        if not batched:
+            writer.flush()
+        count += 1
+    writer.close()
+    source.wait()
+    output.wait()
+    return count
+
+def send(lines, batched):
+    # katawrap ==> KataGo stdin
+    katago = sink()
+    writer = BatchedWriter(katago.stdin) if batched else katago.stdin
+    for line in lines:
+        writer.write((line + '\n').encode())
+        if not batched:
+            writer.flush()
+    writer.close()
+    katago.wait()
+    return len(lines)
+
+def measure(label, func, *func_args):
+    start = time.time()
+    count = func(*func_args)
+    sec = time.time() - start
+    print(f"{label:28} {count / sec:11.1f} lines/s ({sec:.2f}s)", flush=True)
+
+##############################################
+# main
+
+def main():
+    n = args['lines']
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'responses.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(response_line(k, args['move_infos']) + '\n' for k in range(n))
+        measure('responses (per line)', read_and_write, path, False)
+        measure('responses (batched)', read_and_write, path, True)
+    queries = [query_line(k) for k in range(n)]
+    measure('queries (per line)', send, queries, False)
+    measure('queries (batched)', send, queries, True)
+
+if __name__ == "__main__":
+    main()
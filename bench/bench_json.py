@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Benchmark of JSON codecs for -json-codec (katawrap/jsoncodec.py)
+# on real responses. Only installed codecs are measured.
+#
+# (ex.)
+# ./bench_json.py
+# ./bench_json.py -repeat 5 ../sample/sample_result.jsonl
+
+import argparse
+import json
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+import jsoncodec
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark JSON codecs on responses of katawrap.')
+    parser.add_argument('file', metavar='FILE', nargs='?', help='JSONL file', default=os.path.join(here, '..', 'sample', 'sample_result.jsonl'))
+    parser.add_argument('-repeat', metavar='N', type=int, help='repeat N times and take the best', default=3)
+    args = vars(parser.parse_args())
+
+##############################################
+# measure
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def measure(codec, lines, expected):
+    jsoncodec.use(codec)
+    loads, dumps = jsoncodec.loads, jsoncodec.dumps
+    parsed = [loads(line) for line in lines]
+    dumped = [dumps(d) for d in parsed]
+    repeat = args['repeat']
+    return {
+        'loads': best_time(lambda: [loads(line) for line in lines], repeat),
+        'dumps': best_time(lambda: [dumps(d) for d in parsed], repeat),
+        'sameValues': parsed == expected,
+        'sameBytes': dumped == [json.dumps(d) for d in expected],
+    }
+
+def print_result(codec, result, base, mb):
+    speed = lambda key: f"{mb / result[key]:7.1f} MB/s ({base[key] / result[key]:.2f}x)"
+    yes_no = lambda b: 'yes' if b else 'no'
+    print(
+        f"{codec:7} loads {speed('loads')}  dumps {speed('dumps')}  "
+        f"same values: {yes_no(result['sameValues'])}  same bytes: {yes_no(result['sameBytes'])}",
+        flush=True,
+    )
+
+##############################################
+# main
+
+def available_codecs():
+    ret = []
+    for codec in jsoncodec.codecs:
+        try:
+            jsoncodec.use(codec)
+            ret.append(codec)
+        except ImportError:
+            print(f"{codec:7} (not installed)")
+    return ret
+
+if __name__ == "__main__":
+    with open(args['file']) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    expected = [json.loads(line) for line in lines]
+    mb = sum(len(line) for line in lines) / 1024**2
+    codecs = available_codecs()
+    base = measure('json', lines, expected)
+    for codec in codecs:
+        result = base if codec == 'json' else measure(codec, lines, expected)
+        print_result(codec, result, base, mb)
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+# Benchmark of parse_sgf in katawrap (katawrap/sgf_main_branch.py)
+# against the full KaTrain parser. It also checks that the results are
+# identical on SGF files (sample/sgf/*.sgf by default) and on generated
+# game records with variations, comments, setup stones, etc.
+#
+# (ex.)
+# ./bench_sgf.py
+# ./bench_sgf.py -games 1000 /path/to/*.sgf
+
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+import katawrap
+import sgf_main_branch
+from katrain.sgf_parser import SGF
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark parse_sgf of katawrap.')
+    parser.add_argument('files', metavar='FILE', nargs='*', help='SGF files', default=glob.glob(os.path.join(here, '..', 'sample', 'sgf', '*.sgf')))
+    parser.add_argument('-games', metavar='N', type=int, help='number of generated games', default=300)
+    parser.add_argument('-moves', metavar='N', type=int, help='max moves in a generated game', default=250)
+    parser.add_argument('-variations', metavar='N', type=int, help='max variations in a generated game', default=30)
+    parser.add_argument('-repeat', metavar='N', type=int, help='repeat N times and take the best', default=3)
+    parser.add_argument('-seed', metavar='N', type=int, help='random seed', default=1)
+    args = vars(parser.parse_args())
+
+##############################################
+# generated games
+
+letters = 'abcdefghijklmnopqrs'
+
+def random_point():
+    return random.choice(letters) + random.choice(letters)
+
+def random_comment():
+    words = ['good', 'bad', 'B+R', 'a]b', 'c\\d', '[x]', '(y)', ';z', '\n']
+    escape = lambda s: s.replace('\\', '\\\\').replace(']', '\\]')
+    return escape(' '.join(random.choice(words) for _ in range(random.randint(1, 30))))
+
+def random_node(color, with_extra=True):
+    move = random.choice([random_point()] * 50 + ['', 'tt'])
+    node = f";{color}[{move}]"
+    if with_extra and random.random() < 0.3:
+        node += f"C[{random_comment()}]"
+    if with_extra and random.random() < 0.05:
+        node += f"LB[{random_point()}:A][{random_point()}:B]"
+    if with_extra and random.random() < 0.02:
+        node += f"AB[{random_point()}]AW[{random_point()}]"
+    return node + random.choice(['', '\n', ' '])
+
+def random_sequence(n, color):
+    nodes = []
+    for _ in range(n):
+        nodes.append(random_node(color))
+        color = 'W' if color == 'B' else 'B'
+    return ''.join(nodes), color
+
+def random_branch(n, color, variations):
+    # nested variations with the main branch as the first child
+    seq, color = random_sequence(random.randint(0, n), color)
+    rest = n - seq.count(';')
+    if rest <= 0 or variations <= 0:
+        return seq
+    k = random.randint(1, min(3, variations))
+    children = [random_branch(rest if i == 0 else random.randint(1, 20), color, (variations - k) // k)
+                for i in range(k)]
+    return seq + ''.join(f"({c})" for c in children)
+
+def random_root():
+    props = [
+        f"GM[1]FF[4]SZ[{random.choice(['19', '19', '13', '9', '19:13'])}]",
+        random.choice(['KM[6.5]', 'KM[7.5]', 'KM[0]', 'KM[?]', '']),
+        random.choice(['RU[Japanese]', 'RU[chinese]', 'RU[tromp-taylor]', '']),
+        random.choice(['', '', 'HA[2]AB[dd][pp]', 'AB[aa:cc]AW[dd]', 'AB[dd]PL[B]', 'AW[pp]']),
+        f"PB[{random_comment()}]PW[white]RE[B+R]DT[2024-01-01]",
+        random.choice(['', f"C[{random_comment()}]", 'SiZe[19]', 'AP[foxwq]']),
+    ]
+    return ';' + ''.join(props) + random.choice(['', '\n'])
+
+def random_game():
+    root = random_root()
+    main = random_branch(random.randint(1, args['moves']), 'B', random.randint(0, args['variations']))
+    game = f"({root}{main})"
+    r = random.random()
+    if r < 0.03:
+        # variations at the root
+        game = f"({root}({random_node('W')}{main})({random_node('B')}))"
+    elif r < 0.06:
+        # setup node before moves
+        game = f"({root};AB[qq]{main})"
+    elif r < 0.08:
+        # collection of games
+        game += f"\n(;SZ[19]{random_node('B')})"
+    elif r < 0.10:
+        game = f"(;{game[1:-1]};)"
+    return game
+
+##############################################
+# measure
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def parse_all(sgfs):
+    ret = []
+    for sgf in sgfs:
+        try:
+            ret.append(katawrap.parse_sgf(sgf))
+        except Exception as e:
+            ret.append(repr(e))
+    return ret
+
+def parse_all_fully(sgfs):
+    original = katawrap.parse_main_branch
+    katawrap.parse_main_branch = SGF.parse_sgf
+    try:
+        return parse_all(sgfs)
+    finally:
+        katawrap.parse_main_branch = original
+
+def falls_back(sgf):
+    try:
+        return sgf_main_branch.try_parse_main_branch(sgf) is None
+    except Exception:
+        return False  # error as SGF.parse_sgf
+
+def traced(func):
+    # (bytes, blocks) allocated by func and still alive after it
+    tracemalloc.start()
+    try:
+        kept = func()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = snapshot.statistics('filename')
+    return sum(s.size for s in stats), sum(s.count for s in stats)
+
+def parse_trees(parse, sgfs):
+    # keep trees with moves cached as in parse_sgf
+    ret = []
+    for sgf in sgfs:
+        try:
+            root = parse(sgf)
+            katawrap.gtp_moves_in_main_branch(root)
+            ret.append(root)
+        except Exception:
+            pass
+    return ret
+
+def report(title, sgfs):
+    fast = parse_all(sgfs)
+    full = parse_all_fully(sgfs)
+    different = sum(a != b for a, b in zip(fast, full))
+    fallback = sum(falls_back(sgf) for sgf in sgfs)
+    t_fast = best_time(lambda: parse_all(sgfs), args['repeat'])
+    t_full = best_time(lambda: parse_all_fully(sgfs), args['repeat'])
+    mb = sum(len(sgf) for sgf in sgfs) / 1024**2
+    print(f"{title}: {len(sgfs)} games, {mb:.1f} MB, fallback {fallback}, different {different}")
+    print(f"  full   {len(sgfs) / t_full:9.1f} games/s")
+    print(f"  fast   {len(sgfs) / t_fast:9.1f} games/s ({t_full / t_fast:.2f}x)")
+    for label, parse in [('full', SGF.parse_sgf), ('fast', sgf_main_branch.parse_main_branch)]:
+        size, blocks = traced(lambda: parse_trees(parse, sgfs))
+        print(f"  {label} trees {size / len(sgfs) / 1024:9.1f} KB/game {blocks / len(sgfs):9.1f} blocks/game")
+    return different
+
+##############################################
+# main
+
+def main():
+    random.seed(args['seed'])
+    different = 0
+    if args['files']:
+        files = []
+        for path in args['files']:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                files.append(f.read())
+        different += report('files', files)
+    different += report('generated', [random_game() for _ in range(args['games'])])
+    sys.exit(1 if different else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Startup benchmark of katawrap.
+#   import: total import time by "python -X importtime" and the heaviest modules
+#   first query: time from the start of katawrap to the first query
+#                received by a dummy engine (shell one-liner)
+#
+# (ex.)
+# ./bench_startup.py
+# ./bench_startup.py -katawrap /path/to/old/katawrap.py
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark startup time of katawrap.')
+    parser.add_argument('-katawrap', metavar='PATH', help='katawrap.py to be measured', default=os.path.join(here, '..', 'katawrap', 'katawrap.py'))
+    parser.add_argument('-repeat', metavar='N', type=int, help='repeat N times and take the median', default=10)
+    parser.add_argument('-top', metavar='N', type=int, help='show N heaviest modules', default=10)
+    args = vars(parser.parse_args())
+
+sgf = '(;SZ[19]KM[6.5];B[pd];W[dp])'
+
+##############################################
+# import time
+
+def import_times():
+    # {module: cumulative microseconds} for the modules imported directly
+    # by "import" statements outside any other module (i.e. top-level ones)
+    command = [sys.executable, '-X', 'importtime', args['katawrap'], '-h']
+    stderr = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # "import time:  SELF | CUMULATIVE | NAME" (NAME is indented by nesting)
+        _, cumulative_us, name = line.split('|')
+        if name.startswith('  '):
+            continue  # not top-level
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+##############################################
+# first query
+
+def first_query_seconds(tmp):
+    stamp = os.path.join(tmp, 'stamp')
+    engine = ['sh', '-c', f'head -c 1 > /dev/null; date +%s.%N > {stamp}']
+    command = [sys.executable, args['katawrap'], '-silent', '-sequentially', *engine]
+    start = time.time()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+    process.communicate(sgf + '\n')
+    with open(stamp) as f:
+        return float(f.read()) - start
+
+##############################################
+# main
+
+def main():
+    times = import_times()
+    print(f"import: {sum(times.values()) / 1000:.1f} ms in total")
+    for name, us in sorted(times.items(), key=lambda z: -z[1])[:args['top']]:
+        print(f"  {us / 1000:7.1f} ms  {name}")
+    with tempfile.TemporaryDirectory() as tmp:
+        secs = [first_query_seconds(tmp) for _ in range(args['repeat'])]
+    print(f"first query: {statistics.median(secs) * 1000:.1f} ms (median of {len(secs)})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# End-to-end throughput benchmark of katawrap with fake_katago.py.
+#
+# (ex.)
+# ./bench_throughput.py -save before.json
+# (modify katawrap)
+# ./bench_throughput.py -compare before.json
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+katawrap = os.path.join(here, '..', 'katawrap', 'katawrap.py')
+fake_katago = os.path.join(here, 'fake_katago.py')
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark katawrap with fake KataGo.')
+    parser.add_argument('-orders', metavar='LIST', help='comma-separated values for -order', default='arrival,sort,join')
+    parser.add_argument('-extras', metavar='LIST', help='comma-separated values for -extra', default='normal,rich,excess')
+    parser.add_argument('-games', metavar='LIST', help='comma-separated numbers of input games', default='2,10')
+    parser.add_argument('-moves', metavar='N', type=int, help='moves per game', default=50)
+    parser.add_argument('-visits', metavar='N', type=int, help='maxVisits in queries', default=100)
+    parser.add_argument('-katawrap-options', metavar='OPTS', help='additional options for katawrap, e.g. "-include-policy"', default='')
+    parser.add_argument('-fake-options', metavar='OPTS', help='additional options for fake_katago.py, e.g. "-latency 0.01 -reorder"', default='')
+    parser.add_argument('-timeout', metavar='SEC', type=float, help='kill katawrap after SEC seconds for each case', default=600)
+    parser.add_argument('-save', metavar='PATH', help='save results as JSON', default=None)
+    parser.add_argument('-compare', metavar='PATH', help='compare results with saved JSON', default=None)
+    args = vars(parser.parse_args())
+
+##############################################
+# input
+
+def random_sgf(moves, rand):
+    coords = 'abcdefghijklmnopqrs'
+    nodes = ''.join(
+        f";{'BW'[k % 2]}[{rand.choice(coords)}{rand.choice(coords)}]"
+        for k in range(moves)
+    )
+    return f"(;SZ[19]KM[6.5]PB[black]PW[white]RE[B+R]{nodes})"
+
+def input_text(games, moves):
+    rand = random.Random(games)
+    return ''.join(random_sgf(moves, rand) + '\n' for _ in range(games))
+
+##############################################
+# run
+
+def run_case(order, extra, games):
+    text = input_text(games, args['moves'])
+    with tempfile.TemporaryDirectory() as tmp:
+        stats_path = os.path.join(tmp, 'stats.json')
+        command = [
+            sys.executable, katawrap, '-silent',
+            '-order', order, '-extra', extra, '-visits', str(args['visits']),
+            *args['katawrap_options'].split(),
+            sys.executable, fake_katago, '-stats', stats_path,
+            *args['fake_options'].split(),
+        ]
+        input_path = os.path.join(tmp, 'input.txt')
+        with open(input_path, 'w') as f:
+            f.write(text)
+        with open(input_path) as stdin:
+            start = time.time()
+            process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE)
+            timer = threading.Timer(args['timeout'], process.kill)
+            timer.start()
+            output_bytes = sum(len(chunk) for chunk in iter(lambda: process.stdout.read(1024**2), b''))
+            _, status, usage = os.wait4(process.pid, 0)
+            timer.cancel()
+            wall = time.time() - start
+        engine = read_json(stats_path)
+    responses = games * (args['moves'] + 1)
+    return {
+        'order': order,
+        'extra': extra,
+        'games': games,
+        'responses': responses,
+        'status': status,
+        'wall': wall,
+        'responsesPerSec': responses / wall,
+        'katawrapCpu': usage.ru_utime + usage.ru_stime,
+        'katawrapMaxRssKb': usage.ru_maxrss,
+        'engineCpu': engine.get('cpu'),
+        'outputBytes': output_bytes,
+    }
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+##############################################
+# report
+
+def case_key(result):
+    return (result['order'], result['extra'], result['games'])
+
+def print_result(result, baseline):
+    order, extra, games = case_key(result)
+    ratio = ''
+    if baseline:
+        base = baseline.get(case_key(result))
+        if base:
+            ratio = f" ({result['responsesPerSec'] / base['responsesPerSec']:.2f}x)"
+    engine_cpu = result['engineCpu']
+    engine = '?' if engine_cpu is None else f"{engine_cpu:.2f}"
+    print(
+        f"{order:8} {extra:7} games={games:<5} "
+        f"{result['responsesPerSec']:9.1f} res/s{ratio} "
+        f"cpu={result['katawrapCpu']:.2f}s+{engine}s "
+        f"rss={result['katawrapMaxRssKb'] // 1024}MB",
+        flush=True,
+    )
+
+def load_baseline(path):
+    if path is None:
+        return None
+    with open(path) as f:
+        return {case_key(r): r for r in json.load(f)['results']}
+
+def main():
+    baseline = load_baseline(args['compare'])
+    cases = itertools.product(
+        args['orders'].split(','),
+        args['extras'].split(','),
+        [int(z) for z in args['games'].split(',')],
+    )
+    results = []
+    for order, extra, games in cases:
+        result = run_case(order, extra, games)
+        print_result(result, baseline)
+        results.append(result)
+    if args['save']:
+        with open(args['save'], 'w') as f:
+            json.dump({'args': args, 'results': results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+# Stand-in for "katago analysis" to test and benchmark katawrap
+# without GPU. It does not play Go at all. It only returns responses
+# shaped like real ones (see ../sample/sample_result.jsonl).
+#
+# (ex.)
+# ls ../sample/sgf/*.sgf | ../katawrap/katawrap.py ./fake_katago.py -latency 0.01
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Fake KataGo analysis engine for benchmarks.')
+    parser.add_argument('-latency', metavar='SEC', type=float, help='delay of each response', default=0.0)
+    parser.add_argument('-latency-per-visit', metavar='SEC', type=float, help='additional delay per maxVisits', default=0.0)
+    parser.add_argument('-jitter', metavar='SEC', type=float, help='random extra delay that makes responses out of order', default=0.0)
+    parser.add_argument('-reorder', action='store_true', help='shuffle responses of each query')
+    parser.add_argument('-error-rate', metavar='P', type=float, help='probability of error response for each query', default=0.0)
+    parser.add_argument('-warning-rate', metavar='P', type=float, help='probability of warning response for each query', default=0.0)
+    parser.add_argument('-move-infos', metavar='N', type=int, help='max length of moveInfos', default=10)
+    parser.add_argument('-pv', metavar='N', type=int, help='length of pv', default=10)
+    parser.add_argument('-humansl-rank', metavar='RANK', help='make humanPolicy of the actual next move peak at humanSLProfile rank_RANK (e.g. "3k")', default=None)
+    parser.add_argument('-seed', type=int, help='random seed', default=0)
+    parser.add_argument('-stats', metavar='PATH', help='write CPU time and peak RSS to PATH as JSON at exit', default=None)
+    args = vars(parser.parse_args())
+
+##############################################
+# responses
+
+gtp_columns = 'ABCDEFGHJKLMNOPQRSTUVWXYZ'
+
+def responses_for(query, rand):
+    if 'action' in query:
+        return [{'id': query.get('id'), 'action': query['action']}]
+    if rand.random() < args['error_rate']:
+        return [{'id': query.get('id'), 'error': 'Fake error'}]
+    turns = query.get('analyzeTurns') or [len(query.get('moves', []))]
+    responses = [response_for(query, t, rand) for t in turns]
+    if rand.random() < args['warning_rate']:
+        responses.insert(0, {'id': query.get('id'), 'warning': 'Fake warning', 'field': 'fake'})
+    if args['reorder']:
+        rand.shuffle(responses)
+    return responses
+
+def response_for(query, turn, rand):
+    x = query.get('boardXSize', 19)
+    y = query.get('boardYSize', 19)
+    visits = query.get('maxVisits', 500)
+    player = 'B' if turn % 2 == 0 else 'W'
+    winrate = rand.random()
+    score = (winrate - 0.5) * 20
+    n = max(1, min(args['move_infos'], visits))
+    priors = sorted((rand.random() for _ in range(n)), reverse=True)
+    move_infos = [move_info(k, p, x, y, visits, n, winrate, score, rand) for k, p in enumerate(priors)]
+    rand.shuffle(move_infos)  # katawrap sorts them by 'order'
+    response = {
+        'id': query.get('id'),
+        'isDuringSearch': False,
+        'moveInfos': move_infos,
+        'rootInfo': {
+            'currentPlayer': player,
+            'rawStScoreError': rand.random(),
+            'rawStWrError': rand.random() / 10,
+            'rawVarTimeLeft': rand.random() * 10,
+            'scoreLead': score,
+            'scoreSelfplay': score * 1.1,
+            'scoreStdev': 8 + rand.random(),
+            'symHash': '%032X' % rand.getrandbits(128),
+            'thisHash': '%032X' % rand.getrandbits(128),
+            'utility': winrate * 2 - 1,
+            'visits': visits,
+            'weight': visits * 1.4,
+            'winrate': winrate,
+        },
+        'turnNumber': turn,
+    }
+    if query.get('includeOwnership'):
+        response['ownership'] = [rand.uniform(-1, 1) for _ in range(x * y)]
+    if query.get('includePolicy'):
+        response['policy'] = policy(x * y + 1, rand)
+        profile = (query.get('overrideSettings') or {}).get('humanSLProfile')
+        if profile:
+            response['humanPolicy'] = policy(x * y + 1, rand)
+            if args['humansl_rank']:
+                fake_human_prior(response['humanPolicy'], query, turn, profile)
+    return response
+
+def move_info(order, prior, x, y, visits, n, winrate, score, rand):
+    w = min(1, max(0, winrate + rand.uniform(-0.05, 0.05)))
+    s = score + rand.uniform(-1, 1)
+    v = max(1, visits // (order + 2))
+    return {
+        'lcb': w - 0.01,
+        'move': random_move(x, y, rand),
+        'order': order,
+        'prior': prior / n,
+        'pv': [random_move(x, y, rand) for _ in range(args['pv'])],
+        'scoreLead': s,
+        'scoreMean': s,
+        'scoreSelfplay': s * 1.1,
+        'scoreStdev': 8 + rand.random(),
+        'utility': w * 2 - 1,
+        'utilityLcb': w * 2 - 1.1,
+        'visits': v,
+        'weight': v * 1.4,
+        'winrate': w,
+    }
+
+def random_move(x, y, rand):
+    return f"{gtp_columns[rand.randrange(x)]}{rand.randrange(y) + 1}"
+
+def policy(n, rand):
+    p = [rand.random() for _ in range(n)]
+    s = sum(p)
+    return [z / s for z in p]
+
+def fake_human_prior(human_policy, query, turn, profile):
+    # Emulate a player of the given rank. The prior of the actual next move
+    # is the highest at that rank and decreases smoothly with distance.
+    moves = query.get('moves', [])
+    if turn >= len(moves):
+        return
+    x = query.get('boardXSize', 19)
+    y = query.get('boardYSize', 19)
+    distance = dan_of(profile.replace('rank_', '')) - dan_of(args['humansl_rank'])
+    # same noise for the same turn and profile regardless of the order of queries
+    noise = random.Random(f"{args['seed']}:{turn}:{profile}").uniform(0.5, 1.5)
+    prior = 0.3 * math.exp(- (distance / 4) ** 2) * noise + 1e-3
+    human_policy[policy_index(moves[turn][1], x, y)] = prior
+
+def dan_of(rank):
+    n, unit = int(rank[:-1]), rank[-1]
+    return n if unit == 'd' else 1 - n
+
+def policy_index(move, x, y):
+    if move.lower() == 'pass':
+        return x * y
+    column = gtp_columns.index(move[0].upper())
+    row = int(move[1:])
+    return column + (y - row) * x
+
+def delay_for(query, rand):
+    visits = query.get('maxVisits', 500)
+    jitter = rand.uniform(0, args['jitter']) if args['jitter'] > 0 else 0
+    return args['latency'] + args['latency_per_visit'] * visits + jitter
+
+##############################################
+# main loop
+
+# queries: STDIN ==> [main thread] ==> heap of (due, seq, responses)
+# responses: heap ==> [writer thread] ==> STDOUT
+
+def main():
+    rand = random.Random(args['seed'])
+    heap = []
+    condition = threading.Condition()
+    finished = []
+    writer = threading.Thread(target=write_responses, args=(heap, condition, finished), daemon=True)
+    writer.start()
+    for seq, line in enumerate(sys.stdin):
+        if not line.strip():
+            continue
+        query = json.loads(line)
+        due = time.time() + delay_for(query, rand)
+        responses = responses_for(query, rand)
+        with condition:
+            heapq.heappush(heap, (due, seq, responses))
+            condition.notify()
+    with condition:
+        finished.append(True)
+        condition.notify()
+    writer.join()
+    write_stats()
+
+def write_responses(heap, condition, finished):
+    out = sys.stdout
+    while True:
+        with condition:
+            while not heap and not finished:
+                condition.wait()
+            if not heap:
+                return
+            due, _, responses = heap[0]
+            wait = due - time.time()
+            if wait > 0:
+                condition.wait(wait)
+                continue
+            heapq.heappop(heap)
+            drained = not heap
+        if drained:
+            # katawrap may kill us soon after the last response.
+            write_stats()
+        try:
+            out.write(''.join(json.dumps(r) + '\n' for r in responses))
+            out.flush()
+        except BrokenPipeError:
+            return
+
+def write_stats():
+    path = args['stats']
+    if path is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'maxrss_kb': usage.ru_maxrss,
+    }
+    # atomic replace since katawrap may kill us at any time
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp, path)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,65 @@
+# Read SGF files in zip and tar archives directly without extracting them.
+# A member is specified as "ARCHIVE!MEMBER" (e.g. "games.zip!2024/001.sgf").
+# Each archive is opened only once and kept open until close_all().
+#
+# Compressed tar (.tar.gz etc.) is not seekable. Its members are read
+# efficiently only in the order of the archive, as in member_paths().
+# (zipfile and tarfile are imported only when an archive is opened.)
+
+separator = '!'
+zip_suffixes = ('.zip',)
+tar_suffixes = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+handles = {}  # archive path ==> (file object, read function, {member name: member info})
+
+def is_archive(path):
+    return path.lower().endswith(zip_suffixes + tar_suffixes)
+
+def split_member_path(path):
+    # "a.zip!b/c.sgf" ==> ("a.zip", "b/c.sgf")
+    # or None if path is not in an archive ("!" is allowed in normal paths)
+    k = path.find(separator)
+    while k >= 0:
+        if is_archive(path[:k]):
+            return path[:k], path[k + 1:]
+        k = path.find(separator, k + 1)
+    return None
+
+def member_path(archive, member):
+    return f"{archive}{separator}{member}"
+
+def read_member(archive, member):
+    # Return bytes. Raise KeyError if member is missing.
+    _, read, infos = open_archive(archive)
+    return read(infos[member])
+
+def member_paths(archive, suffix='.sgf'):
+    # "ARCHIVE!MEMBER" for all files whose names end with suffix
+    _, _, infos = open_archive(archive)
+    return [member_path(archive, name) for name in infos if name.lower().endswith(suffix)]
+
+def open_archive(archive):
+    handle = handles.get(archive)
+    if handle is None:
+        handle = handles[archive] = new_handle(archive)
+    return handle
+
+def new_handle(archive):
+    if archive.lower().endswith(zip_suffixes):
+        import zipfile
+        z = zipfile.ZipFile(archive)
+        infos = {i.filename: i for i in z.infolist() if not i.is_dir()}
+        return z, z.read, infos
+    import tarfile
+    t = tarfile.open(archive, mode='r:*')
+    # index by name since TarFile.getmember is a linear search
+    infos = {i.name: i for i in t.getmembers() if i.isfile()}
+    def read(info):
+        with t.extractfile(info) as f:
+            return f.read()
+    return t, read, infos
+
+def close_all():
+    for f, _, _ in handles.values():
+        f.close()
+    handles.clear()
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import deque
+
+# Line I/O with fewer system calls for high-throughput pipes
+# (e.g. maxVisits=1 queries for -scan-humansl-ranks).
+#   LineReader: read large chunks and split lines on bytes
+#   BatchedWriter: coalesce writes and flush them by size or time
+# Pass strict=True to BatchedWriter for flushing every write
+# (interactive pipes).
+
+class LineReader:
+
+    def __init__(self, stream, chunk_size=1024**2):
+        # stream must be binary (e.g. process.stdout, sys.stdin.buffer)
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._lines = deque()
+        self._rest = b''
+
+    def readline(self):
+        # stripped str. '' at EOF or for an empty line (like "readline().strip()")
+        if not self._lines and not self._fill():
+            return ''
+        return self._lines.popleft().decode().strip()
+
+    def _fill(self):
+        # read1 returns available bytes without waiting for chunk_size
+        chunk = self._stream.read1(self._chunk_size)
+        if not chunk:
+            rest, self._rest = self._rest, b''
+            if rest:
+                self._lines.append(rest)
+            return bool(rest)
+        lines = (self._rest + chunk).split(b'\n')
+        self._rest = lines.pop()
+        self._lines.extend(lines)
+        return True
+
+class BatchedWriter:
+
+    def __init__(self, stream, flush_size=64 * 1024, flush_interval=0.1, strict=False):
+        self._stream = stream
+        self._flush_size = flush_size
+        self._strict = strict
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        if not strict:
+            threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True).start()
+
+    def write(self, data):
+        # data is str or bytes according to stream
+        with self._lock:
+            self._stream.write(data)
+            self._pending += len(data)
+            if self._strict or self._pending >= self._flush_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending and not self._closed:
+                self._flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._closed = True
+            self._stream.close()
+
+    # private
+
+    def _flush(self):
+        self._pending = 0
+        self._stream.flush()
+
+    def _flush_periodically(self, interval):
+        while not self._closed:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except (BrokenPipeError, ValueError):
+                # ValueError: stream is closed by others
+                return
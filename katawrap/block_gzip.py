@@ -0,0 +1,105 @@
+import gzip
+import os
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Write gzip in independent blocks ("members") compressed in parallel.
+# Each block holds complete lines only, so the output can be read by
+# standard zcat and can be truncated or resumed at any block boundary.
+
+class BlockGzipWriter:
+
+    def __init__(
+            self,
+            path,
+            mode='wb',
+            block_size=1024**2,
+            threads=None,
+            compresslevel=6,
+    ):
+        self._file = open(path, mode)
+        self._block_size = block_size
+        self._compresslevel = compresslevel
+        threads = threads or min(8, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = threads * 2
+        self._pending = deque()
+        self._buffer = []
+        self._buffered_size = 0
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        data = text.encode()
+        with self._lock:
+            self._buffer.append(data)
+            self._buffered_size += len(data)
+            if self._buffered_size >= self._block_size:
+                self._submit_block()
+
+    def flush(self):
+        # Note that this closes the current block.
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._flush()
+            self._executor.shutdown()
+            self._file.close()
+
+    def _flush(self):
+        self._submit_block()
+        self._write_pending(wait_all=True)
+        self._file.flush()
+
+    def _submit_block(self):
+        if not self._buffer:
+            return
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered_size = 0
+        future = self._executor.submit(compress_block, block, self._compresslevel)
+        self._pending.append(future)
+        self._write_pending()
+
+    def _write_pending(self, wait_all=False):
+        # keep the order of blocks
+        pending = self._pending
+        while pending and (wait_all or len(pending) > self._max_pending or pending[0].done()):
+            self._file.write(pending.popleft().result())
+
+def compress_block(block, compresslevel):
+    # mtime=0 for reproducible output
+    return gzip.compress(block, compresslevel=compresslevel, mtime=0)
+
+def read_members(path, chunk_size=1024**2):
+    # Yield (end_offset, data) for each complete gzip member in the file
+    # so that a truncated last member can be detected and dropped.
+    # Reading stops at the first broken member (e.g. garbage after the
+    # last complete member when the writer was killed).
+    offset = 0
+    decompressor = zlib.decompressobj(wbits=31)
+    data = []
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            while chunk:
+                try:
+                    data.append(decompressor.decompress(chunk))
+                except zlib.error:
+                    return
+                if not decompressor.eof:
+                    offset += len(chunk)
+                    break
+                rest = decompressor.unused_data
+                offset += len(chunk) - len(rest)
+                yield (offset, b''.join(data))
+                data = []
+                decompressor = zlib.decompressobj(wbits=31)
+                chunk = rest
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Walk directories in parallel and yield files as soon as they are found
+# (in no particular order). Each directory is scanned by os.scandir in a
+# thread pool. Files can be also hashed there (e.g. for dedup).
+# Symbolic links to directories are not followed.
+
+finished = object()
+batch_size = 256
+
+def walk_files(top, suffixes, read=None, on_error=None):
+    # Yield (path, digest) for files whose names end with suffixes
+    # (lowercased). digest is a hash of read(path) if read is given
+    # and it succeeds. Otherwise, it is None.
+    found = queue.Queue()
+    pending = 0
+    lock = threading.Lock()
+    executor = ThreadPoolExecutor()
+
+    def submit(task, path):
+        nonlocal pending
+        with lock:
+            pending += 1
+        executor.submit(run, task, path)
+
+    def run(task, path):
+        nonlocal pending
+        try:
+            task(path)
+        finally:
+            with lock:
+                pending -= 1
+                if pending == 0:
+                    found.put(finished)
+
+    def scan(path):
+        # Files are put in batches to reduce overhead.
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        submit(scan, entry.path)
+                    elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                        files.append(entry.path)
+                        if len(files) >= batch_size:
+                            submit(put_files, files)
+                            files = []
+        except OSError as e:
+            if on_error:
+                on_error(e)
+        if files:
+            put_files(files)
+
+    def put_files(files):
+        found.put([(f, None if read is None else digest_of(f, read)) for f in files])
+
+    submit(scan, top)
+    try:
+        while True:
+            files = found.get()
+            if files is finished:
+                return
+            yield from files
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def digest_of(path, read):
+    try:
+        return hashlib.blake2b(read(path), digest_size=16).digest()
+    except Exception:
+        return None
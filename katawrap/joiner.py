@@ -2,23 +2,29 @@ import sys
 
 class Joiner:
 
-    def __init__(self, join_pairs=None, cook_successive_pairs=None):
+    def __init__(self, join_pairs=None, cook_successive_pairs=None, size_of=None):
         self._join_pairs = join_pairs
         self._cook_successive_pairs = cook_successive_pairs
+        self._size_of = size_of or (lambda req: 0)
         self._pool = []
         self._pop_count = 0
+        self._pool_size = 0
 
     def count(self):
         to_join = len(self._pool)
         popped = self._pop_count
         return (to_join, popped)
 
+    def size(self):
+        return self._pool_size
+
     def push_pairs(self, pairs):
         return sum([self._push_pair(p) for p in pairs], [])
 
     def _push_pair(self, pair):
         self._cook_successive_pairs_before_push(pair)
         self._pool.append(pair)
+        self._pool_size += self._size_of(pair[0])
         if self._join_pairs:
             return self._pop_joined_responses()
         elif self._needs_successive_pair(pair):
@@ -26,6 +32,12 @@ class Joiner:
         else:
             return self._pop_responses()
 
+    def give_up(self, query_id):
+        # Drop the held pairs of the query after error.
+        dropped = [(req, res) for req, res in self._pool if req['id'] == query_id]
+        self._pool = [(req, res) for req, res in self._pool if req['id'] != query_id]
+        self._pool_size -= sum(self._size_of(req) for req, _ in dropped)
+
     # pop
 
     def _pop_responses(self, butlast=False):
@@ -39,6 +51,7 @@ class Joiner:
         ret = lis[s]
         del lis[s]
         self._pop_count += len(ret)
+        self._pool_size -= sum(self._size_of(req) for req, _ in ret)
         return ret
 
     def _pick_responses(self, pairs):
@@ -0,0 +1,53 @@
+import json
+
+# JSON codec with optional faster backends (-json-codec NAME).
+# "auto" parses with orjson or ujson if installed, but writes with the
+# standard json module so that the output bytes do not depend on which
+# packages are installed. Give the name of a backend explicitly to use
+# it also for writing. Call use() before loads() and dumps().
+#
+# The parsed values are the same for all backends. The output of
+# dumps() is byte-compatible with json.dumps() only for "json" and "auto":
+#   orjson: no spaces after ',' and ':', non-ASCII characters as is,
+#           NaN and Infinity as null
+#   ujson:  no spaces after ',' and ':'
+# Use json.dumps() directly where the exact bytes matter (e.g. hashes).
+
+def orjson_codec():
+    import orjson
+    option = orjson.OPT_NON_STR_KEYS
+    return orjson.loads, lambda obj: orjson.dumps(obj, option=option).decode()
+
+def ujson_codec():
+    import ujson
+    return ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False)
+
+def json_codec():
+    return json.loads, json.dumps
+
+codecs = {
+    'orjson': orjson_codec,
+    'ujson': ujson_codec,
+    'json': json_codec,
+}
+
+name = 'json'
+loads, dumps = json_codec()
+
+def use(codec='auto'):
+    # Return the name of the selected backend for loads().
+    global name, loads, dumps
+    candidates = list(codecs) if codec == 'auto' else [codec]
+    for c in candidates:
+        if not c in codecs:
+            raise ValueError(f'Unknown JSON codec "{c}". Available codecs are: auto, {", ".join(codecs)}')
+        try:
+            loads, dumps = codecs[c]()
+        except ImportError:
+            if codec != 'auto':
+                raise
+            continue
+        if codec == 'auto':
+            dumps = json.dumps
+        name = c
+        return name
@@ -12,20 +12,33 @@
 # sorted request-response pairs.
 
 import argparse
-import gzip
+import hashlib
 import json
 import math
-import subprocess
+import os
+import re
 import sys
 import threading
 import time
-import uuid
+from collections import deque
 
 from sorter import Sorter
+from batched_io import LineReader, BatchedWriter
+import archive
+import sgf_collection
+import dir_walk
+import jsoncodec
+from timing import Timers, NullTimers
+from metrics import Rate, to_json, to_prometheus, write_atomically, rss_bytes, serve_metrics, parse_address
 from board import board_from_moves, board_after_move
-from util import find_if, flatten, warn, parse_json, merge_dict, is_executable
+from util import count_lines, find_if, flatten, warn, parse_json, merge_dict, is_executable
 
-from katrain.sgf_parser import SGF, Move
+from katrain.sgf_parser import Move
+from sgf_main_branch import parse_main_branch
+
+# Modules for optional features (gzip, subprocess, cProfile, tracer,
+# reducers, etc.) are imported where they are used so that short runs
+# start quickly. See bench/bench_startup.py.
 
 ##############################################
 # parse args
@@ -51,18 +64,49 @@ if __name__ == "__main__":
     parser.add_argument('-last', action='store_true', help='equivalent to specification in -override')
     parser.add_argument('-include-policy', action='store_true', help='equivalent to specification in -override')
     parser.add_argument('-scan-humansl-ranks', action='store_true', help='scan humanSLProfile rank_*')
+    parser.add_argument('-scan-humansl-ranks-adaptively', action='store_true', help='scan humanSLProfile rank_* only around likely ranks')
     parser.add_argument('-order', help='"arrival", "sort" (default), or "join"', default='sort', required=False)
     parser.add_argument('-extra', help='"normal", "rich", or "excess" (default)', default='excess', required=False)
+    parser.add_argument('-refine-visits', metavar='VISITS', type=int, help='re-analyze critical turns with VISITS (0 = disabled)', default=0, required=False)
+    parser.add_argument('-refine-winrate-gain', metavar='GAIN', type=float, help='turns are critical if |nextWinrateGain| >= GAIN (0 = ignored, default = 0.1)', default=0.1, required=False)
+    parser.add_argument('-refine-score-gain', metavar='GAIN', type=float, help='turns are critical if |nextScoreGain| >= GAIN (0 = ignored, default = 3.0)', default=3.0, required=False)
+    parser.add_argument('-refine-unsettledness', metavar='U', type=float, help='turns are critical if unsettledness >= U (0 = ignored)', default=0, required=False)
+    parser.add_argument('-early-stop', metavar='K', type=int, help='stop analyzing a game when the result is decided for K consecutive turns (0 = disabled)', default=0, required=False)
+    parser.add_argument('-early-stop-winrate', metavar='W', type=float, help='the result is decided if winrate >= W or <= 1 - W (0 = ignored, default = 0.99)', default=0.99, required=False)
+    parser.add_argument('-early-stop-score', metavar='S', type=float, help='the result is decided if |scoreLead| >= S (0 = ignored)', default=0, required=False)
+    parser.add_argument('-early-stop-chunk', metavar='N', type=int, help='send N turns at once for -early-stop (default = 20)', default=20, required=False)
     parser.add_argument('-max-requests', type=int, help='suspend sending queries when pending requests exceeds this number (0 = unlimited)', default=1000, required=False)
+    parser.add_argument('-output', metavar='PATH', help='write responses to PATH instead of stdout (compressed in parallel if PATH ends with ".gz")', default=None, required=False)
+    parser.add_argument('-resume-output', metavar='PATH', help='skip turns that are already found in PATH and append new responses to it', default=None, required=False)
+    parser.add_argument('-shard', metavar='I/N', help='process only the lines whose index k satisfies k %% N == I (see katawrap_merge.py)', default=None, required=False)
+    parser.add_argument('-max-visits-in-flight', metavar='VISITS', type=int, help='suspend sending queries when the total maxVisits of pending requests exceeds this number (0 = unlimited)', default=0, required=False)
+    parser.add_argument('-max-buffer-mb', metavar='MB', type=float, help='suspend sending queries when the estimated size of unreleased responses exceeds this (0 = unlimited)', default=0, required=False)
+    parser.add_argument('-auto-limits', action='store_true', help='adjust -max-visits-in-flight automatically from the observed throughput')
     parser.add_argument('-sequentially', action='store_true', help='do not read all input lines at once')
+    parser.add_argument('-input', metavar='PATH', help='read queries from PATH instead of stdin (lines are counted in background for progress with -sequentially)', default=None, required=False)
+    parser.add_argument('-input-archive', metavar='PATH', help='read all *.sgf in zip or tar(.gz/.bz2/.xz) archive PATH instead of stdin (as "PATH!MEMBER" in sgfFile)', default=None, required=False)
+    parser.add_argument('-input-dir', metavar='DIR', help='read all *.sgf(.gz/.bz2/.xz) under DIR recursively instead of stdin (in the order they are found)', default=None, required=False)
+    parser.add_argument('-dedup', action='store_true', help='skip duplicated files in -input-dir and write {"sgfFile": ..., "duplicateOf": ...} instead of their responses')
     parser.add_argument('-only-last', action='store_true', help='analyze only the last turn when analyzeTurns is missing')
     parser.add_argument('-sgf-encoding', metavar='ENCODINGS', help='use ENCODINGS (e.g. "utf-8,latin-1") to read SGF file', default='utf-8,latin-1,cp932,euc_jp,iso2022_jp', required=False)
+    parser.add_argument('-split-sgf-collections', action='store_true', help='analyze every game tree in each sgfFile (with "gameIndex" in responses) instead of only the first one')
     parser.add_argument('-disable-sgf-file', action='store_true', help='do not support sgfFile in query')
     parser.add_argument('-suspend-to', metavar='PATH', help='use pre-post wrapping like "katawrap.py -suspend-to PATH | katago | katawrap.py -resume-from PATH"', default=None, required=False)
     parser.add_argument('-resume-from', metavar='PATH', help='use pre-post wrapping like "katawrap.py -suspend-to PATH | katago | katawrap.py -resume-from PATH"', default=None, required=False)
+    parser.add_argument('-json-codec', metavar='NAME', help='"auto" (default), "orjson", "ujson", or "json" (auto = the fastest installed one)', default='auto', required=False)
+    parser.add_argument('-line-buffered', action='store_true', help='flush output and queries to KataGo for every line (otherwise they are flushed by size or every 0.1 sec)')
     parser.add_argument('-netcat', action='store_true', help='use this option when netcat (nc) is used as katago command')
     parser.add_argument('-silent', action='store_true', help='do not print progress info to stderr')
     parser.add_argument('-debug', action='store_true', help='print debug info to stderr')
+    parser.add_argument('-timing', action='store_true', help='print time spent in each stage to stderr at the end')
+    parser.add_argument('-reduce', metavar='NAME[:K=V,...]', help='output only aggregates of responses, e.g. "estimate_rank:by=player,output=json"', default=None, required=False)
+    parser.add_argument('-reduce-save', metavar='PATH', help='save aggregates of -reduce to PATH at the end', default=None, required=False)
+    parser.add_argument('-reduce-load', metavar='PATHS', help='load and merge saved aggregates (comma-separated PATHS) at the start', default=None, required=False)
+    parser.add_argument('-metrics', metavar='PATH', help='rewrite PATH with metrics every second (Prometheus text format if PATH ends with ".prom", JSON otherwise)', default=None, required=False)
+    parser.add_argument('-metrics-socket', metavar='[HOST:]PORT', help='serve metrics by HTTP (/metrics for Prometheus, /metrics.json for JSON)', default=None, required=False)
+    parser.add_argument('-timing-fields', action='store_true', help='add "timing" field (sent, arrived, released) to each response')
+    parser.add_argument('-trace', metavar='PATH', help='write latency of each query to PATH in Chrome trace-event format', default=None, required=False)
+    parser.add_argument('-profile', metavar='PATH', help='dump cProfile stats of the main thread and the response thread to PATH', default=None, required=False)
     parser.add_argument('-unsettledness-by-entropy', action='store_true', help='experimental (undocumented)')
     parser.add_argument('-soft-moyo', action='store_true', help='experimental (undocumented)')
     parser.add_argument('katago-command', metavar='KATAGO_COMMAND', help='(ex.) ./katago analysis -config analysis.cfg -model model.bin.gz', nargs=argparse.REMAINDER)
@@ -79,17 +123,18 @@ if __name__ == "__main__":
         override['includePolicy'] = True
     override_orig = override
     override_list = parse_json(args['override_list'] or '[]')
+    humansl_ranks = [f'{i}d' for i in reversed(range(1, 10))] + [f'{i}k' for i in range(1, 21)]
+    humansl_coarse_step = 4
+    humansl_override = lambda r: {
+        'maxVisits': 1,
+        'includePolicy': True,
+        'overrideSettings': {'humanSLProfile': f'rank_{r}'},
+    }
     if args['scan_humansl_ranks']:
-        override_list += [
-            {
-                'maxVisits': 1,
-                'includePolicy': True,
-                'overrideSettings': {'humanSLProfile': f'rank_{r}'},
-            }
-            for r in
-            [f'{i}d' for i in reversed(range(1, 10))] +
-            [f'{i}k' for i in range(1, 21)]
-        ]
+        override_list += [humansl_override(r) for r in humansl_ranks]
+    elif args['scan_humansl_ranks_adaptively']:
+        # template for all profiles (see "adaptive HumanSL rank scan")
+        override_list += [humansl_override(humansl_ranks[0])]
     if not override_list:
         override_list = [{}]
     for key in ['komi', 'rules']:
@@ -102,31 +147,262 @@ if __name__ == "__main__":
         parser.print_help(sys.stderr)
         exit(1)
 
+    if sum(1 for k in ['input', 'input_archive', 'input_dir'] if args[k]) > 1:
+        print("Use only one of -input, -input-archive, and -input-dir.", file=sys.stderr)
+        exit(1)
+
+    for k in ['input', 'input_archive', 'input_dir']:
+        if args[k] and not os.path.exists(args[k]):
+            print(f"No such file or directory for -{k.replace('_', '-')}: {args[k]}", file=sys.stderr)
+            exit(1)
+
+    if args['input_dir'] and args['shard']:
+        print("-input-dir cannot be used with -shard since the order of files is not fixed.", file=sys.stderr)
+        exit(1)
+
+    if args['input_dir'] and args['resume_output']:
+        print("-input-dir cannot be used with -resume-output since the order of files is not fixed.", file=sys.stderr)
+        exit(1)
+
+    if args['dedup'] and not args['input_dir']:
+        print("-dedup needs -input-dir.", file=sys.stderr)
+        exit(1)
+
+    if args['dedup'] and args['suspend_to']:
+        print("-dedup cannot be used with -suspend-to.", file=sys.stderr)
+        exit(1)
+
+    if args['input_archive'] and not archive.is_archive(args['input_archive']):
+        print("-input-archive supports only " + ', '.join(archive.zip_suffixes + archive.tar_suffixes) + ".", file=sys.stderr)
+        exit(1)
+
+    if args['split_sgf_collections'] and args['disable_sgf_file']:
+        print("-split-sgf-collections cannot be used with -disable-sgf-file.", file=sys.stderr)
+        exit(1)
+
+    if args['output'] and args['resume_output']:
+        print("Use only one of -output and -resume-output.", file=sys.stderr)
+        exit(1)
+
+    if args['refine_visits'] > 0:
+        if args['order'] == 'arrival' or args['extra'] == 'normal':
+            print("-refine-visits needs -order sort (or join) and -extra rich (or excess).", file=sys.stderr)
+            exit(1)
+        if args['suspend_to'] or args['resume_from']:
+            print("-refine-visits cannot be used with -suspend-to or -resume-from.", file=sys.stderr)
+            exit(1)
+
+    if args['scan_humansl_ranks_adaptively']:
+        conflicts = ['suspend_to', 'resume_from', 'resume_output', 'shard', 'early_stop', 'refine_visits']
+        if any(args[k] for k in conflicts):
+            print("-scan-humansl-ranks-adaptively cannot be used with " + ', '.join('-' + k.replace('_', '-') for k in conflicts) + ".", file=sys.stderr)
+            exit(1)
+
+    if args['reduce'] and args['extra'] != 'excess':
+        print("-reduce needs -extra excess.", file=sys.stderr)
+        exit(1)
+
+    if args['reduce']:
+        from reducers import make_reducer
+        try:
+            make_reducer(args['reduce'])
+        except ValueError as e:
+            print(f"Invalid -reduce {args['reduce']} ({e})", file=sys.stderr)
+            exit(1)
+
+    if args['early_stop'] > 0:
+        if args['suspend_to'] or args['resume_from']:
+            print("-early-stop cannot be used with -suspend-to or -resume-from.", file=sys.stderr)
+            exit(1)
+
+    try:
+        jsoncodec.use(args['json_codec'])
+    except (ValueError, ImportError) as e:
+        print(f"Invalid -json-codec {args['json_codec']} ({e})", file=sys.stderr)
+        exit(1)
+
+    shard = None
+    if args['shard']:
+        try:
+            shard = tuple(int(z) for z in args['shard'].split('/'))
+            i, n = shard
+            assert 0 <= i < n
+        except:
+            print(f"Invalid -shard {args['shard']} (0 <= I < N is required for I/N)", file=sys.stderr)
+            exit(1)
+
+# stage timers (no-op without -timing)
+timers = Timers() if __name__ == "__main__" and args['timing'] else NullTimers()
+timed = timers.decorate
+
 ##############################################
 # cook
 
 def cook_json_to_jsonlist(func, line, sorter):
-    return [json.dumps(z) for z in func(parse_json(line), sorter)]
+    with timers.timed('json_loads'):
+        parsed = parse_json(line)
+    cooked = func(parsed, sorter)
+    with timers.timed('json_dumps'):
+        return [jsoncodec.dumps(z) for z in cooked]
 
 def cook_query_json(line, sorter):
     return cook_json_to_jsonlist(cook_query, fill_placeholder(line), sorter)
 
 def cook_response_json(line, sorter):
+    if passthrough:
+        passed = pass_response_through(line, sorter)
+        if passed is not None:
+            return passed
+    elif lazy_parsing:
+        cooked = cook_response_lazily(line, sorter)
+        if cooked is not None:
+            return cooked
     return cook_json_to_jsonlist(cook_response, line, sorter)
 
 def cook_query(query, sorter):
+    if is_reference(query):
+        return cook_reference_query(query, sorter)
     needs_extra = (args['extra'] != 'normal')
     katago_queries, requests = cooked_queries_and_requests(query, needs_extra, warn)
-    sorter.push_requests(requests)
+    if args['scan_humansl_ranks_adaptively']:
+        return start_rank_scan(katago_queries, requests)
+    unsent = split_into_chunks(katago_queries, requests)
+    sorter.push_requests(requests, is_unsent=lambda req: request_key(req) in unsent)
+    counters['sentTurnsTotal'] += len(requests)
+    keep_refine_templates(katago_queries)
+    counters['sentWorkTotal'] += sum(estimated_work(req) for req in requests)
+    trace_sent(katago_queries, requests)
     return katago_queries
 
 def cook_response(response, sorter):
+    if response.get('id') in reference_ids:
+        return cook_reference_response(response, sorter)
+    if response.get('id') in refine_ids:
+        return cook_refined_response(response, sorter)
+    if is_probe(response):
+        return cook_probe_response(response, sorter)
     if handle_invalid_response(response, sorter, warn):
-        return []
-    pairs = sorter.push_response(response)
+        # Later pairs may be released after error.
+        with timers.timed('sorter'):
+            pairs = sorter.pop_pairs()
+        return cook_and_release_pairs(pairs, sorter)
+    trace_arrived(response)
+    check_early_stop(response, sorter)
+    update_rank_scan(response, sorter)
+    count_visits(response)
+    with timers.timed('sorter'):
+        pairs = sorter.push_response(response)
+    return cook_and_release_pairs(pairs, sorter)
+
+def cook_and_release_pairs(pairs, sorter):
     for req, res in pairs:
-        cook_pair(req, res)
-    return sorter.push_pairs_to_joiner(pairs)
+        if is_reference(req):
+            add_input_index(req, res)
+        else:
+            cook_pair(req, res)
+    with timers.timed('joiner'):
+        released = sorter.push_pairs_to_joiner(pairs)
+    trace_released(released)
+    return reduce_responses(released)
+
+def count_visits(response):
+    counters['visitsTotal'] += response.get('rootInfo', {}).get('visits', 0)
+
+##############################################
+# passthrough
+
+# For "-order arrival -extra normal", responses are not modified at all.
+# So we only scan id and turnNumber in the raw line for Sorter and
+# forward the line as is. Other responses (error, warning, etc.) are
+# processed as usual.
+
+passthrough = False
+passthrough_id = re.compile(r'"id":\s*("(?:[^"\\]|\\.)*")')
+passthrough_turn = re.compile(r'"turnNumber":\s*(\d+)')
+passthrough_exclusion = re.compile(r'"(?:error|warning|action|noResults)":|"isDuringSearch":\s*true')
+
+def enable_passthrough():
+    global passthrough
+    passthrough = can_pass_through()
+
+def can_pass_through():
+    modifiers = ['shard', 'timing_fields', 'reduce', 'refine_visits', 'early_stop', 'scan_humansl_ranks_adaptively']
+    return (
+        args['order'] == 'arrival' and args['extra'] == 'normal'
+        and not any(args[k] for k in modifiers)
+    )
+
+def pass_response_through(line, sorter):
+    # Return None for fallback.
+    scanned = scan_response_key(line, sorter)
+    if scanned is None:
+        return None
+    response, req = scanned
+    trace_arrived(response)
+    with timers.timed('sorter'):
+        pairs = sorter.push_response(response, req)
+        released = sorter.push_pairs_to_joiner(pairs)
+    trace_released(released)
+    return [line] if released else []
+
+def scan_response_key(line, sorter):
+    # ({'id': ..., 'turnNumber': ...}, request) for a usual response.
+    # None for others (error, warning, etc.).
+    if passthrough_exclusion.search(line):
+        return None
+    i, turn = passthrough_id.search(line), passthrough_turn.search(line)
+    if not (i and turn):
+        return None
+    response = {'id': jsoncodec.loads(i.group(1)), 'turnNumber': int(turn.group(1))}
+    req = sorter.get_request_for(response)
+    if req is None:
+        return None
+    return (response, req)
+
+##############################################
+# lazy parsing
+
+# Responses that wait for earlier turns in Sorter (-order sort or join)
+# can be much larger as Python objects than as JSON text. So we keep
+# only id, turnNumber, and the raw line in Sorter, and parse the line
+# when it is released. This is disabled for the options that need
+# the contents of responses on arrival.
+
+lazy_parsing = False
+raw_line_key = '_rawLine'
+
+def enable_lazy_parsing():
+    global lazy_parsing
+    lazy_parsing = not (args['early_stop'] or args['scan_humansl_ranks_adaptively'])
+
+def cook_response_lazily(line, sorter):
+    # Return None for fallback.
+    scanned = scan_response_key(line, sorter)
+    if scanned is None or scanned[0]['id'] in refine_ids:
+        return None
+    response, req = scanned
+    response[raw_line_key] = line
+    trace_arrived(response)
+    with timers.timed('sorter'):
+        pairs = sorter.push_response(response, req)
+    # One by one so that all pooled responses are not parsed at once
+    # when the blocking turn arrives. Raw lines are also freed one by one.
+    lines = []
+    pairs = deque(pairs)
+    while pairs:
+        req, res = pairs.popleft()
+        cooked = cook_and_release_pairs([(req, parse_raw_response(res))], sorter)
+        with timers.timed('json_dumps'):
+            lines.extend(jsoncodec.dumps(z) for z in cooked)
+    return lines
+
+def parse_raw_response(response):
+    if raw_line_key not in response:
+        return response  # reference to a duplicated file
+    with timers.timed('json_loads'):
+        parsed = jsoncodec.loads(response[raw_line_key])
+    count_visits(parsed)
+    return parsed
 
 ##############################################
 # cook query
@@ -141,16 +417,19 @@ def cooked_queries_and_requests(orig_query, needs_extra, error_reporter):
         error_reporter(f"{err} in {katago_query} (from {query})")
         return ([], [])
     additional = extra if needs_extra else {}
-    requests = expand_query_turns(merge_dict(query, katago_query, additional))
+    requests = expand_query_turns(merge_dict(query, katago_query, additional, input_index_fields()))
+    requests = drop_resumed_turns(katago_query, requests)
+    if not requests:
+        return ([], [])
     return ([katago_query], requests)
 
 def cooked_query_for_katago(given_query, override_after_sgf):
     query = given_query.copy()
-    add_id(query)
     cook_sgf_file(query)
     extra = cook_sgf(query)
     query.update(override_after_sgf)
     if not(has_valid_moves_field(query)):
+        add_id(query)
         return (query, extra)
     cook_alias(query)
     cook_analyze_turns_every(query)
@@ -160,14 +439,14 @@ def cooked_query_for_katago(given_query, override_after_sgf):
     cook_include_unsettledness(query)
     fix_rules(query)
     guess_rules_etc(query)
+    add_id(query)  # after all fields are fixed
     return (query, extra)
 
 # each cook
 
 def add_id(query):
-    i = new_id()
     if not 'id' in query:
-        query['id'] = i
+        query['id'] = content_id(query)
 
 field_alias = {
     'from': 'analyzeTurnsFrom',
@@ -185,26 +464,54 @@ def cook_alias(query):
             del query[field]
             query[original] = value
 
+@timed('read_sgf_file')
 def cook_sgf_file(query):
     sgf_file = query.pop('sgfFile', None)
+    game_index = query.pop('gameIndex', None)
     if sgf_file is None:
         return
     if (args['disable_sgf_file']):
         warn(f"sgfFile is disabled by the option -disable-sgf-file: {sgf_file}")
         return
-    opener = gzip.open if sgf_file.endswith('gz') else open
     try:
-        with opener(sgf_file, mode='rb') as f:
-            raw = f.read()
-            for encoding in args['sgf_encoding'].split(','):
-                try:
-                    query['sgf'] = raw.decode(encoding)
-                    return
-                except:
-                    pass
-            query['skipMe'] = f"Failed to read SGF file: {sgf_file}\n"
+        if game_index is None:
+            raw = read_sgf_file(sgf_file)
+        else:
+            raw = sgf_collection.read_game(sgf_file, game_index, open_sgf_file)
     except:
-        query['skipMe'] = f"Failed to open SGF file: {sgf_file}\n"
+        raw = None
+    if raw is None:
+        query['skipMe'] = f"Failed to open SGF file: {sgf_file}" + ("" if game_index is None else f" (gameIndex {game_index})") + "\n"
+        return
+    for encoding in args['sgf_encoding'].split(','):
+        try:
+            query['sgf'] = raw.decode(encoding)
+            return
+        except:
+            pass
+    query['skipMe'] = f"Failed to read SGF file: {sgf_file}\n"
+
+def read_sgf_file(sgf_file):
+    with open_sgf_file(sgf_file) as f:
+        return f.read()
+
+def open_sgf_file(sgf_file):
+    in_archive = archive.split_member_path(sgf_file)
+    if in_archive:
+        import io
+        return io.BytesIO(archive.read_member(*in_archive))
+    if sgf_file.endswith('gz'):
+        import gzip
+        opener = gzip.open
+    elif sgf_file.endswith('bz2'):
+        import bz2
+        opener = bz2.open
+    elif sgf_file.endswith('xz'):
+        import lzma
+        opener = lzma.open
+    else:
+        opener = open
+    return opener(sgf_file, mode='rb')
 
 def cook_sgf(query):
     sgf = query.pop('sgf', None)
@@ -317,11 +624,22 @@ def fill_placeholder(line):
     if line.startswith('{'):
         return line
     key = 'sgf' if line.startswith('(;') else 'sgfFile'
-    return json.dumps({key: line})
+    return jsoncodec.dumps({key: line})
 
+@timed('expand_query_turns')
 def expand_query_turns(query):
     return [merge_dict(query, {'turnNumber': t}) for t in query['analyzeTurns']]
 
+def drop_resumed_turns(katago_query, requests):
+    # Requests keep the original analyzeTurns so that their responses
+    # are identical to those in an uninterrupted run.
+    if not resumed_turns:
+        return requests
+    remaining = [req for req in requests if (req['id'], req['turnNumber']) not in resumed_turns]
+    counters['resumedTurnsTotal'] += len(requests) - len(remaining)
+    katago_query['analyzeTurns'] = [req['turnNumber'] for req in remaining]
+    return remaining
+
 ##############################################
 # cook response
 
@@ -330,10 +648,13 @@ def cook_pair(req, res):
     cook_board_in_info(req, res)
     cook_unsettledness(req, res)
     add_extra_response(req, res)
+    add_input_index(req, res)
 
+@timed('sort_move_infos')
 def sort_move_infos(req, res):
     res['moveInfos'].sort(key=lambda z: z['order'])
 
+@timed('add_extra_response')
 def add_extra_response(req, res):
     extra = args['extra']
     if extra == 'normal':
@@ -369,6 +690,12 @@ def extended_root_info(res):
     additional = {k: res[k] for k in keys if k in res}
     return merge_dict(root_info, additional)
 
+def add_input_index(req, res):
+    # sort keys for katawrap_merge.py (also for -extra normal)
+    for k in input_index_keys:
+        if k in req:
+            res[k] = req[k]
+
 def cooked_sgf_prop(req):
     sgf_prop = req.get('sgfProp')
     if not sgf_prop:
@@ -436,13 +763,15 @@ def board_for_info(req, res, info, base_board=None):
     move = [player, info['move']]
     return board_after_move(move, board)
 
+@timed('cook_board_in_info')
 def cook_board_in_info(req, res):
     # add "boad" into each element of "moveInfos" only when includeOwnership
     # is true because of too large overhead in the output size
-    if req['includeOwnership'] and res.get('board'):
+    if req.get('includeOwnership') and res.get('board'):
         for info in res['moveInfos']:
             info['board'] = board_for_info(req, res, info)
 
+@timed('cook_unsettledness')
 def cook_unsettledness(req, res):
     # This is separated from add_extra_response so that one can disable
     # it individually. Note that unsettledness needs ownership,
@@ -555,10 +884,13 @@ def ownership_distribution_idx(o):
 
 def join_pairs(pairs):
     req0, res0 = pairs[0]
+    if is_reference(req0):
+        return res0
     responses = [res for _, res in pairs]
     query = req0.copy()
     del query['turnNumber']
-    return {'id': req0['id'], 'query': query, 'responses': responses}
+    input_index = {k: req0[k] for k in input_index_keys if k in req0}
+    return {'id': req0['id'], **input_index, 'query': query, 'responses': responses}
 
 def cook_successive_pairs(former_pair, latter_pair):
     if args['extra'] == 'normal':
@@ -588,16 +920,23 @@ def handle_invalid_response(response, sorter, error_reporter):
     if is_ignorable_response(response, sorter):
         return True  # drop silently
     if is_warning_response(response):
+        counters['warningsTotal'] += 1
         error_reporter(f"Got warning: {response} for {req}")
         return False
     return False
 
 def give_up_queries_for_error_response(response, sorter, error_reporter):
+    counters['errorsTotal'] += 1
     i = response.get('id')
     if i is None:
         error_reporter(f"Error (no 'id'): {response}")
         return
     requests = sorter.pop_requests_by_id(i)
+    with early_stop_lock:
+        early_stop_states.pop(i, None)
+    give_up_rank_scan(i, sorter)
+    if tracer:
+        tracer.forget(i)
     first_req = requests[0] if requests else '(No corresponding request)'
     error_reporter(f"Got error: {response} for {first_req}")
 
@@ -627,7 +966,7 @@ def print_progress(sorter):
     q = progress_of_queries()
     w, p, j, d, requests = sorter.count()
     # message = f"[q] {q} [res] wait={w} pool={p} join={j} done={d} ... "
-    r = progress_of_responses(w, requests)
+    r = progress_of_responses(sorter)
     message = f"[in {q}] [out{r} {w}>{p}>{j}>{d}] {ti} ... "
     warn(message, overwrite=True)
 
@@ -635,39 +974,54 @@ def progress_of_queries():
     total = '' if total_queries is None else f"/{total_queries}"
     return f"{processed_queries}{total}"
 
-def progress_of_responses(waiting, requests):
-    if total_queries is None:
+def progress_of_responses(sorter):
+    fraction = progress_fraction(sorter)
+    if fraction is None:
         return ''
-    if requests == 0 or processed_queries == 0:
-        return ' 0%'
-    responses = requests - waiting
-    p = processed_queries / total_queries
-    is_guess = p < 1
-    s = math.floor(responses / requests * p * 100)
+    is_guess = processed_queries < total_queries
+    s = math.floor(fraction * 100)
     return f" {s}%{'?' if is_guess else ''}"
 
+def progress_fraction(sorter):
+    # weighted by estimated work (turns x visits) rather than lines
+    if total_queries is None:
+        return None
+    sent = counters['sentWorkTotal']
+    if sent == 0 or processed_queries == 0:
+        return 0.0
+    p = processed_queries / total_queries
+    return done_work(sorter) / sent * p
+
+def done_work(sorter):
+    in_flight, _ = sorter.cost()
+    return counters['sentWorkTotal'] - in_flight
+
 def finish_print_progress(interrupted):
     if not args['silent']:
         warn('\nInterrupted.' if interrupted else 'All done.')
 
 def elapsed_time_string():
-    global progress_start_time
-    if progress_start_time is None:
-        progress_start_time = time.time()
-    seconds = int(time.time() - progress_start_time)
+    seconds = int(elapsed_seconds())
     minutes, s = quotient_and_remainder(seconds, 60)
     h, m = quotient_and_remainder(minutes, 60)
     h_str = '' if h < 1 else f"{h}:"
     return f"{h_str}{m:02}:{s:02}"
 
+def elapsed_seconds():
+    global progress_start_time
+    if progress_start_time is None:
+        progress_start_time = time.time()
+    return time.time() - progress_start_time
+
 def quotient_and_remainder(a, b):
     return int(a / b), a % b
 
 ##############################################
 # SGF
 
+@timed('parse_sgf')
 def parse_sgf(sgf):
-    root = SGF.parse_sgf(sgf)
+    root = parse_main_branch(sgf)
     x, y = root.board_size
     ret = {
         'moves': gtp_moves_in_main_branch(root),
@@ -676,7 +1030,7 @@ def parse_sgf(sgf):
         'initialPlayer': root.initial_player,
     }
     extra = {
-        'sgfProp': root.sgf_properties(),
+        'sgfProp': dict(root.properties),  # no deep copy since root is discarded
         'sgf': sgf,
     }
     if root.placements:
@@ -706,21 +1060,71 @@ def main_branch_after(root):
 ##############################################
 # util
 
-query_id_base = uuid.uuid4()
+query_id_base = None
 query_id = -1
 
 def new_id():
-    global query_id
+    global query_id, query_id_base
+    if query_id_base is None:
+        import uuid
+        query_id_base = uuid.uuid4()
     query_id += 1
     return f"{query_id_base}_{query_id}"
 
-def same_by(keys):
-    return lambda a, b: all(a.get(k) == b.get(k) for k in keys)
+content_id_keys = [
+    'moves',
+    'initialStones',
+    'initialPlayer',
+    'rules',
+    'komi',
+    'boardXSize',
+    'boardYSize',
+    'maxVisits',
+    'overrideSettings',
+]
+content_digests = set()  # for duplicated queries
+
+def content_id(query):
+    # Stable id for the same query in every run (-resume-output, caching,
+    # diffing outputs, etc.). Duplicated queries in the run get the index
+    # of the input line as a suffix. With -shard, the suffix is always
+    # added since duplicates in other shards are unknown, so that merged
+    # shards still have unique ids.
+    content = [query.get(k) for k in content_id_keys] + [override_index]
+    text = json.dumps(content, sort_keys=True, separators=(',', ':'), check_circular=False)
+    digest = hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+    if shard is None and digest not in content_digests:
+        content_digests.add(digest)
+        return digest
+    return f"{digest}_{input_index}"
+
+def request_key(z):
+    # for both requests and responses
+    return (z.get('id'), z.get('turnNumber'))
 
 def debug_print(message):
     if args['debug']:
         warn(f"DEBUG {message}")
 
+input_index_keys = ['inputIndex', 'overrideIndex']
+
+def input_index_fields():
+    if shard is None:
+        return {}
+    return {'inputIndex': input_index, 'overrideIndex': override_index}
+
+def in_shard(k):
+    if shard is None:
+        return True
+    i, n = shard
+    return k % n == i
+
+def count_in_shard(total):
+    if shard is None:
+        return total
+    i, n = shard
+    return len(range(i, total, n))
+
 ##############################################
 # sorter & joiner
 
@@ -730,13 +1134,22 @@ def make_sorter():
     sorter = Sorter(
         sort=(order != 'arrival'),
         max_requests=max_requests(),
-        corresponding=same_by(['id', 'turnNumber']),
+        key_of=request_key,
         error_reporter=warn,
         join_pairs=join_pairs if (order == 'join') else None,
         cook_successive_pairs=cook_successive_pairs if (order != 'arrival') else None,
+        max_work=max_work(),
+        max_buffer=max_buffer(),
+        work_of=estimated_work,
+        size_of=estimated_response_size,
+        auto_limit=args['auto_limits'],
+        refine=queue_refinement if args['refine_visits'] > 0 else None,
+        is_critical=is_critical_for_refinement,
+        is_critical_pair=is_critical_pair_for_refinement,
+        refine_finished=forget_refine_template,
     )
     if dumped:
-        with open(dumped, 'r') as f:
+        with open(dumped, 'r', encoding='utf-8') as f:
             sorter.undump_requests(f.read())
     return sorter
 
@@ -744,31 +1157,148 @@ def max_requests():
     m = args['max_requests']
     return m if m > 0 else math.inf
 
+def max_work():
+    m = args['max_visits_in_flight']
+    return m if m > 0 else math.inf
+
+def max_buffer():
+    m = args['max_buffer_mb']
+    return m * 1024**2 if m > 0 else math.inf
+
 def has_requests_limit():
-    return max_requests() < math.inf
+    limits = (max_requests(), max_work(), max_buffer())
+    return any(m < math.inf for m in limits) or args['auto_limits']
+
+# cost estimation for each request (= single turn)
+
+default_visits_for_cost = 500  # unknown maxVisits in KataGo config
+
+def estimated_work(req):
+    if is_reference(req):
+        return 0
+    return req.get('maxVisits') or default_visits_for_cost
+
+def estimated_response_size(req):
+    # rough bytes of JSON text (parsed dict is even larger)
+    if is_reference(req):
+        return 0
+    grids = req['boardXSize'] * req['boardYSize']
+    move_infos = min(estimated_work(req), 50)
+    size = 1000 + 400 * move_infos
+    if req.get('includeOwnership'):
+        size += 20 * grids
+    if req.get('includePolicy'):
+        size += 20 * (grids + 1) * (2 if 'humanSLProfile' in req.get('overrideSettings', {}) else 1)
+    if args['extra'] != 'normal' and req.get('includeOwnership'):
+        # boards in moveInfos
+        size += move_infos * 4 * grids
+    return size
 
 ##############################################
 # katago process
 
 def start_katago():
-    return subprocess.Popen(
+    import subprocess
+    process = subprocess.Popen(
         katago_command,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=sys.stderr,
     )
-
+    # The response thread also sends queries for -refine-visits etc.
+    # BatchedWriter serializes them.
+    process.stdin = batched(process.stdin)
+    return process
+
+def batched(stream):
+    return BatchedWriter(stream, strict=args['line_buffered'])
+
+queued_queries = deque()
+
+def queue_query(query):
+    # Queries are sent after the output is written in the response thread.
+    queued_queries.append(query)
+
+def send_queued_queries(katago_process):
+    # may be called in both threads
+    sent = False
+    while True:
+        try:
+            query = queued_queries.popleft()
+        except IndexError:
+            break
+        send_to_katago(jsoncodec.dumps(query), katago_process)
+        sent = True
+    if sent and katago_process:
+        katago_process.stdin.flush()
+
+@timed('send_to_katago')
 def send_to_katago(line, process):
     if process is None:
         print(line)
         return
     debug_print(f"(to KATAGO): {line}")
     process.stdin.write((line + '\n').encode())
-    process.stdin.flush()
 
 def terminate_all_queries(process):
-    terminate_all = json.dumps({'id': new_id(), 'action': 'terminate_all'})
+    terminate_all = jsoncodec.dumps({'id': new_id(), 'action': 'terminate_all'})
     send_to_katago(terminate_all, process)
+    process.stdin.flush()
+
+def wake_up_response_thread(process, sorter):
+    # The response thread can wait for the next response forever if
+    # nothing is pending at the end of input (e.g. all turns are found
+    # in -resume-output). A harmless action lets it notice the end.
+    if in_progress(process, sorter):
+        return
+    query_version = jsoncodec.dumps({'id': new_id(), 'action': 'query_version'})
+    send_to_katago(query_version, process)
+
+##############################################
+# output
+
+output_stream = None
+resumed_turns = set()
+
+def open_output():
+    global output_stream
+    path = output_path()
+    mode = 'a' if args['resume_output'] else 'w'
+    if path is None:
+        # non-ASCII characters are written as is by -json-codec orjson
+        sys.stdout.reconfigure(encoding='utf-8')
+        output_stream = batched(sys.stdout)
+    elif path.endswith('.gz'):
+        from block_gzip import BlockGzipWriter
+        # blocks are flushed when they are filled
+        output_stream = BlockGzipWriter(path, mode=mode + 'b')
+    else:
+        output_stream = batched(open(path, mode, encoding='utf-8'))
+
+def output_path():
+    return args['resume_output'] or args['output']
+
+def load_resumed_output():
+    global resumed_turns
+    path = args['resume_output']
+    if path is None:
+        return
+    from resume import completed_turns
+    resumed_turns = completed_turns(path)
+    if not args['silent']:
+        warn(f"Found {len(resumed_turns)} responses in {path}")
+
+@timed('write_output')
+def print_output(line):
+    output_stream.write(line + '\n')
+
+def close_output():
+    if output_stream is None:
+        return
+    if output_path() is None:
+        output_stream.flush()  # keep sys.stdout open
+        return
+    output_stream.close()
 
 ##############################################
 # main loop
@@ -776,27 +1306,99 @@ def terminate_all_queries(process):
 # query: STDIN ==> [main thread] ==> KataGo
 
 is_input_finished = False
+input_index = 0
+override_index = 0
 
 def read_queries(katago_process, sorter, thread_condition):
-    global is_input_finished, total_queries, processed_queries, override
+    global is_input_finished, total_queries, processed_queries, override, input_index, override_index
+    input_stream = open_input()
     if args['sequentially']:
-        input_lines = sys.stdin
+        input_lines = input_stream
+        count_input_lines_in_background()
     else:
-        input_lines = sys.stdin.readlines()
-        total_queries = len(input_lines)
+        input_lines = list(input_stream)
+        total_queries = count_in_shard(len(input_lines))
     for k, line in enumerate(input_lines):
-        for o in override_list:
+        if not in_shard(k):
+            continue
+        input_index = k
+        for override_index, o in enumerate(override_list):
             override = override_orig | o
             cook_input_line(line, katago_process, sorter, thread_condition)
-        processed_queries = k + 1
+        processed_queries += 1
     total_queries = processed_queries  # for -sequentially
     is_input_finished = True
+    archive.close_all()
+    sgf_collection.close_reader()
+    if katago_process:
+        wake_up_response_thread(katago_process, sorter)
+        katago_process.stdin.flush()  # without waiting for the periodic flush
+
+def open_input():
+    # iterable of input lines
+    if args['input_archive']:
+        lines = archive_input_lines(args['input_archive'])
+    elif args['input_dir']:
+        lines = dir_input_lines(args['input_dir'])
+    else:
+        path = args['input']
+        lines = sys.stdin if path is None else open(path)
+    return split_sgf_collections(lines) if args['split_sgf_collections'] else lines
+
+def archive_input_lines(path):
+    return [jsoncodec.dumps({'sgfFile': p}) for p in archive.member_paths(path)]
+
+sgf_file_suffixes = ('.sgf', '.sgf.gz', '.sgf.bz2', '.sgf.xz')
+
+def dir_input_lines(top):
+    # Files are read and hashed in parallel for -dedup.
+    first_copy = {}  # digest ==> path
+    read = read_sgf_file if args['dedup'] else None
+    on_error = lambda e: warn(f"Failed to scan directory: {e}")
+    for path, digest in dir_walk.walk_files(top, sgf_file_suffixes, read, on_error):
+        if digest is not None:
+            first = first_copy.setdefault(digest, path)
+            if first != path:
+                counters['duplicateFilesTotal'] += 1
+                yield jsoncodec.dumps({'sgfFile': path, 'duplicateOf': first})
+                continue
+        yield jsoncodec.dumps({'sgfFile': path})
+
+def split_sgf_collections(lines):
+    # {"sgfFile": PATH, ...} ==> {"sgfFile": PATH, ..., "gameIndex": k} for each game
+    # The games are only counted here. They are read in cook_sgf_file.
+    for line in lines:
+        try:
+            query = jsoncodec.loads(fill_placeholder(line.strip()))
+            path = query['sgfFile']
+            n = 0 if 'gameIndex' in query else sgf_collection.count_games(open_sgf_file(path))
+        except:
+            n = 0
+        if n == 0:
+            yield line  # as is (errors are reported later)
+            continue
+        for k in range(n):
+            yield jsoncodec.dumps({**query, 'gameIndex': k})
+
+def count_input_lines_in_background():
+    path = args['input']
+    # Pipes cannot be read twice.
+    # Lines are not queries with -split-sgf-collections.
+    if path is None or not os.path.isfile(path) or args['split_sgf_collections']:
+        return
+    def count():
+        global total_queries
+        total_queries = count_in_shard(count_lines(path))
+    threading.Thread(target=count, daemon=True).start()
 
 def cook_input_line(raw_line, katago_process, sorter, thread_condition):
     line = raw_line.strip()
     debug_print(f"(from STDIN): {line}")
+    if katago_process and not sorter.has_room():
+        # KataGo must have all sent queries before we wait for room.
+        katago_process.stdin.flush()
     push_to_sorter = lambda: cook_query_json(line, sorter)
-    wait_for_room = lambda tc: tc.wait_for(sorter.has_room)
+    wait_for_room = lambda tc: timed('wait_for_room')(tc.wait_for)(sorter.has_room)
     js = with_thread_condition(push_to_sorter, wait_for_room, thread_condition)
     for j in js:
         send_to_katago(j, katago_process)
@@ -810,8 +1412,8 @@ def read_responses(katago_process, sorter, thread_condition):
         warn('BrokenPipe in response thread')
 
 def do_read_responses(katago_process, sorter, thread_condition):
-    read_line = lambda: katago_process.stdout.readline().decode().strip() if katago_process else sys.stdin.readline().strip()
-    source = katago_process.stdout if katago_process else sys.stdin
+    reader = LineReader(katago_process.stdout if katago_process else sys.stdin.buffer)
+    read_line = timed('read_katago')(reader.readline)
     while in_progress(katago_process, sorter):
         line = read_line()
         if not line:
@@ -821,8 +1423,8 @@ def do_read_responses(katago_process, sorter, thread_condition):
         notify = lambda tc: tc.notify()
         js = with_thread_condition(pop_from_sorter, notify, thread_condition)
         for j in js:
-            print(j)
-        sys.stdout.flush()
+            print_output(j)
+        send_queued_queries(katago_process)
 
 def with_thread_condition(cooker, checker, thread_condition):
     if not (has_requests_limit() and thread_condition):
@@ -840,7 +1442,7 @@ def show_progress_periodically(sec, katago_process, sorter):
 
 def in_progress(katago_process, sorter):
     alive = katago_process.poll() is None if katago_process else True
-    done = is_input_finished and not sorter.has_requests()
+    done = is_input_finished and not sorter.has_requests() and not is_rank_scan_in_progress()
     return alive and not done
 
 ##############################################
@@ -856,7 +1458,7 @@ def main():
             is_input_finished = True
             read_responses(katago_process, sorter, thread_condition)
             return
-        read_queries(katago_process, sorter, thread_condition)
+        profiled(read_queries)(katago_process, sorter, thread_condition)
         if response_thread:
             response_thread.join()
         else:
@@ -865,19 +1467,27 @@ def main():
         interrupted = True
     finally:
         print_progress(sorter)
+        finish_reducer()
+        close_output()
+        close_tracer()
+        print_early_stop_summary()
+        print_rank_scan_summary()
+        write_metrics(sorter)
         finalize(katago_process, interrupted)
+        print_timing()
+        dump_profile()
 
 def exit_if_dangerous():
-    path = args['suspend_to']
-    overwriting_exe = path is not None and is_executable(path)
-    if overwriting_exe:
-        print(f"You are trying to overwrite an executable file! ({path})\nAbort.", file=sys.stderr)
-        exit(1)
+    for path in (args['suspend_to'], output_path()):
+        overwriting_exe = path is not None and is_executable(path)
+        if overwriting_exe:
+            print(f"You are trying to overwrite an executable file! ({path})\nAbort.", file=sys.stderr)
+            exit(1)
 
 def dump_sorter(sorter, path):
     if path is None:
         return
-    with open(path, 'w') as f:
+    with open(path, 'w', encoding='utf-8') as f:
         f.write(sorter.dump_requests())
 
 def initialize():
@@ -886,11 +1496,17 @@ def initialize():
     katago_process = None
     response_thread = None
     sorter = make_sorter()
+    load_resumed_output()
+    open_output()
+    open_tracer()
+    open_reducer()
+    enable_passthrough()
+    enable_lazy_parsing()
     thread_condition = threading.Condition() if needs_thread_condition else None
     if needs_katago:
         katago_process = start_katago()
         response_thread = threading.Thread(
-            target=read_responses,
+            target=profiled(read_responses),
             args=(katago_process, sorter, thread_condition),
             daemon=True,
         )
@@ -898,6 +1514,7 @@ def initialize():
     if not args['silent']:
         progress_sec = 1
         start_progress_thread(progress_sec, katago_process, sorter)
+    start_metrics(katago_process, sorter)
     if args['netcat'] and needs_katago:
         # cancel requests by previous client for safety
         terminate_all_queries(katago_process)
@@ -934,5 +1551,623 @@ def finalize_interruption():
     another_netcat.stdin.close()
     warn('...Sent')
 
+##############################################
+# two-pass analysis (-refine-visits)
+
+# Turns are analyzed with the given visits first. Then critical turns
+# are re-analyzed with -refine-visits, and the refined responses
+# replace the original ones in the output. See refiner.py.
+
+refine_templates = {}  # query id => cooked query for KataGo
+refine_ids = {}  # id for refinement => (query id, turn)
+
+def keep_refine_templates(katago_queries):
+    if args['refine_visits'] <= 0:
+        return
+    for q in katago_queries:
+        refine_templates[q['id']] = q
+
+def forget_refine_template(query_id):
+    refine_templates.pop(query_id, None)
+
+def is_critical_for_refinement(pair):
+    threshold = args['refine_unsettledness']
+    _, res = pair
+    return threshold > 0 and res.get('unsettledness', 0) >= threshold
+
+def is_critical_pair_for_refinement(former_pair, latter_pair):
+    # same as nextWinrateGain and nextScoreGain in cook_successive_pairs
+    # except for the sign
+    _, res0 = former_pair
+    _, res1 = latter_pair
+    thresholds = {
+        'winrate': args['refine_winrate_gain'],
+        'scoreLead': args['refine_score_gain'],
+    }
+    root0, root1 = res0['rootInfo'], res1['rootInfo']
+    return any(
+        t > 0 and k in root0 and k in root1 and abs(root1[k] - root0[k]) >= t
+        for k, t in thresholds.items()
+    )
+
+def queue_refinement(pair):
+    # called in Sorter
+    req, _ = pair
+    query_id, turn = req['id'], req['turnNumber']
+    template = refine_templates.get(query_id)
+    if template is None:
+        warn(f"No query for refinement: {query_id}")  # should not happen
+        return
+    refine_id = f"{query_id}:refine:{turn}"
+    refine_ids[refine_id] = (query_id, turn)
+    queue_query(merge_dict(template, {
+        'id': refine_id,
+        'analyzeTurns': [turn],
+        'maxVisits': args['refine_visits'],
+    }))
+
+def cook_refined_response(response, sorter):
+    if is_warning_response(response):
+        counters['warningsTotal'] += 1
+        warn(f"Got warning: {response} (refinement)")
+        return []
+    if response.get('isDuringSearch') or response.get('noResults'):
+        return []
+    query_id, turn = refine_ids.pop(response['id'])
+    if is_error_response(response):
+        # Give up refinement and keep the original response.
+        counters['errorsTotal'] += 1
+        warn(f"Got error: {response} (refinement)")
+        response = None
+    else:
+        counters['refinedTurnsTotal'] += 1
+        response['id'] = query_id
+        response['refined'] = True
+    return sorter.push_refined_response(query_id, turn, response, cook=cook_pair)
+
+##############################################
+# duplicated files (-dedup)
+
+# A duplicated file in -input-dir is not analyzed again. Instead, the
+# reference {"id": ..., "turnNumber": 0, "sgfFile": PATH, "duplicateOf":
+# FIRST_PATH} is written at its place in the output order. It goes
+# through Sorter as a pair of the reference itself, and the "response"
+# is triggered by the reply to a harmless action sent to KataGo.
+
+reference_ids = {}  # query id => reference
+reference_keys = ['id', 'turnNumber', 'sgfFile', 'gameIndex', 'duplicateOf']
+
+def is_reference(z):
+    return 'duplicateOf' in z
+
+def cook_reference_query(query, sorter):
+    # Return the action sent to KataGo instead of the query.
+    reference = merge_dict(
+        {k: query[k] for k in reference_keys if k in query},
+        {'id': new_id(), 'turnNumber': 0, 'analyzeTurns': [0]},  # for Joiner and Refiner
+        input_index_fields(),
+    )
+    reference_ids[reference['id']] = reference
+    sorter.push_requests([reference])
+    return [{'id': reference['id'], 'action': 'query_version'}]
+
+def cook_reference_response(response, sorter):
+    reference = reference_ids.pop(response['id'])
+    res = {k: reference[k] for k in reference_keys if k in reference}
+    with timers.timed('sorter'):
+        pairs = sorter.push_response(res)
+    return cook_and_release_pairs(pairs, sorter)
+
+##############################################
+# early stop (-early-stop)
+
+# Turns of each game are sent in chunks. When all responses for a chunk
+# arrive, the rest of turns are given up if the result is decided for
+# K consecutive turns. Otherwise, the next chunk is sent.
+# The given-up turns are removed from the shared analyzeTurns in
+# requests so that Joiner and Refiner see the actual last turn.
+
+early_stop_lock = threading.Lock()
+early_stop_states = {}  # query id => state
+
+def split_into_chunks(katago_queries, requests):
+    # Return (id, turnNumber) of turns in later chunks (not sent yet).
+    unsent = set()
+    if args['early_stop'] <= 0:
+        return unsent
+    chunk = max(1, args['early_stop_chunk'])
+    for q in katago_queries:
+        turns = q.get('analyzeTurns') or []
+        if len(turns) <= chunk:
+            continue
+        reqs = [req for req in requests if req['id'] == q['id']]
+        unsent.update((q['id'], t) for t in turns[chunk:])
+        with early_stop_lock:
+            early_stop_states[q['id']] = {
+                'template': q.copy(),
+                'chunk': turns[:chunk],
+                'rest': turns[chunk:],
+                'waiting': set(turns[:chunk]),
+                'decided': {},
+                'streak': 0,
+                'analyzeTurns': reqs[0]['analyzeTurns'] if reqs else [],  # shared by requests
+            }
+        q['analyzeTurns'] = turns[:chunk]
+    return unsent
+
+def check_early_stop(response, sorter):
+    # called in the response thread
+    with early_stop_lock:
+        update_early_stop(response, sorter)
+
+def update_early_stop(response, sorter):
+    i, turn = response.get('id'), response.get('turnNumber')
+    state = early_stop_states.get(i)
+    if state is None or turn not in state['waiting']:
+        return
+    state['waiting'].remove(turn)
+    state['decided'][turn] = is_decided(response)
+    if state['waiting']:
+        return
+    for t in state['chunk']:
+        state['streak'] = state['streak'] + 1 if state['decided'][t] else 0
+    state['decided'] = {}
+    if state['streak'] >= args['early_stop']:
+        give_up_rest_turns(i, state, sorter)
+    else:
+        send_next_chunk(i, state, sorter)
+
+def is_decided(response):
+    root_info = response.get('rootInfo', {})
+    w, s = args['early_stop_winrate'], args['early_stop_score']
+    winrate, score = root_info.get('winrate'), root_info.get('scoreLead')
+    decided_by_winrate = w > 0 and winrate is not None and max(winrate, 1 - winrate) >= w
+    decided_by_score = s > 0 and score is not None and abs(score) >= s
+    return decided_by_winrate or decided_by_score
+
+def send_next_chunk(i, state, sorter):
+    chunk = max(1, args['early_stop_chunk'])
+    turns, rest = state['rest'][:chunk], state['rest'][chunk:]
+    if not rest:
+        del early_stop_states[i]
+    else:
+        state.update({'chunk': turns, 'rest': rest, 'waiting': set(turns)})
+    sorter.mark_sent_by_id(i, set(turns))
+    queue_query(merge_dict(state['template'], {'analyzeTurns': turns}))
+
+def give_up_rest_turns(i, state, sorter):
+    del early_stop_states[i]
+    skipped = set(state['rest'])
+    analyze_turns = state['analyzeTurns']
+    analyze_turns[:] = [t for t in analyze_turns if t not in skipped]
+    requests = sorter.pop_requests_by_id(i, turns=skipped)
+    counters['earlyStoppedTurnsTotal'] += len(requests)
+    counters['earlyStoppedWorkTotal'] += sum(estimated_work(req) for req in requests)
+    if tracer:
+        tracer.skipped(i, len(requests))
+
+def print_early_stop_summary():
+    if args['early_stop'] <= 0 or args['silent']:
+        return
+    turns = counters['earlyStoppedTurnsTotal']
+    visits = counters['earlyStoppedWorkTotal']
+    warn(f"Early stop: skipped {turns} turns (about {visits} visits)")
+
+##############################################
+# adaptive HumanSL rank scan (-scan-humansl-ranks-adaptively)
+
+# The cooked query of each input line is used as a template.
+# (1) Probe: only a sample of its turns is analyzed with every 4th profile
+# of rank_9d..rank_20k at first. When all responses for them arrive, we
+# calculate the posterior of ranks for each color as estimate_rank.py
+# does, and probe the neighbors (+-2 ranks) of the leading candidates,
+# i.e. the top ranks whose posterior mass passes rank_scan_mass.
+# Probing stops early when the top rank alone passes it.
+# Responses for probes are not written.
+# (2) Analyze: all turns are analyzed with the best probed rank and its
+# neighbors. Then the neighbors of the leading candidates are analyzed
+# until no new rank is needed, so that the best rank is not beaten by
+# its neighbors. Only these responses are written, and they have the
+# same turns for all profiles.
+# (The output order of profiles is not preserved in this case.)
+
+rank_scan_lock = threading.Lock()
+rank_scan_groups = {}  # query id of template => group
+rank_scan_ids = {}  # query id => group
+rank_scan_turn_sample = 4  # probe 1/4 of turns
+rank_scan_mass = 0.99  # posterior mass of leading candidates
+rank_scan_min_probe_step = 2  # +-1 rank is left to the analysis of all turns
+rank_scan_full_turns = 0  # for the summary
+
+def start_rank_scan(katago_queries, requests):
+    # Return probes for the coarse scan.
+    global rank_scan_full_turns
+    if not katago_queries:
+        return []
+    katago_query = katago_queries[0]
+    group = {
+        'template': (katago_query, requests),
+        'turns': sampled_turns(katago_query['analyzeTurns']),
+        'waiting': {},  # query id => number of waiting responses
+        'rank_of': {},  # query id => (rank index, 'probed' or 'analyzed')
+        'probed': {},  # rank index => {color: sum of log prior} for sampled turns
+        'analyzed': {},  # rank index => {color: sum of log prior} for all turns
+        'tried': set(),  # rank indices in 'analyzed' including errors
+        'step': humansl_coarse_step,
+    }
+    with rank_scan_lock:
+        rank_scan_groups[katago_query['id']] = group
+        rank_scan_full_turns += len(requests) * len(humansl_ranks)
+        return [probe_for_rank(group, r) for r in range(0, len(humansl_ranks), humansl_coarse_step)]
+
+def sampled_turns(turns):
+    # pairs of successive turns for both colors
+    n = 2 * rank_scan_turn_sample
+    return [t for k, t in enumerate(turns) if k % n < 2]
+
+def probe_for_rank(group, rank):
+    katago_query, _ = group['template']
+    i = f"{katago_query['id']}:probe:{humansl_ranks[rank]}"
+    add_rank_scan_query(group, i, rank, 'probed', len(group['turns']))
+    return merge_dict(katago_query, {
+        'id': i,
+        'analyzeTurns': group['turns'],
+        'overrideSettings': profile_settings(katago_query, rank),
+    })
+
+def cloned_query_for_rank(group, rank):
+    katago_query, requests = group['template']
+    i = f"{katago_query['id']}:{humansl_ranks[rank]}"
+    add_rank_scan_query(group, i, rank, 'analyzed', len(requests))
+    group['tried'].add(rank)
+    fields = {'id': i, 'overrideSettings': profile_settings(katago_query, rank)}
+    return (merge_dict(katago_query, fields), [merge_dict(req, fields) for req in requests])
+
+def add_rank_scan_query(group, i, rank, table, turns):
+    group['waiting'][i] = turns
+    group['rank_of'][i] = (rank, table)
+    group[table][rank] = {}
+    rank_scan_ids[i] = group
+    counters['rankScanQueriesTotal'] += 1
+    counters['rankScanTurnsTotal'] += turns
+
+def profile_settings(katago_query, rank):
+    return merge_dict(
+        katago_query.get('overrideSettings', {}),
+        {'humanSLProfile': f'rank_{humansl_ranks[rank]}'},
+    )
+
+def is_probe(response):
+    group = rank_scan_ids.get(response.get('id'))
+    return group is not None and group['rank_of'][response['id']][1] == 'probed'
+
+def cook_probe_response(response, sorter):
+    if is_warning_response(response):
+        counters['warningsTotal'] += 1
+        warn(f"Got warning: {response} (rank scan)")
+        return []
+    if response.get('isDuringSearch'):
+        return []
+    if is_error_response(response):
+        counters['errorsTotal'] += 1
+        warn(f"Got error: {response} (rank scan)")
+        give_up_rank_scan(response['id'], sorter)
+        return []
+    update_rank_scan(response, sorter)
+    return []
+
+def update_rank_scan(response, sorter):
+    i = response.get('id')
+    group = rank_scan_ids.get(i)
+    if group is None:
+        return
+    with rank_scan_lock:
+        add_log_likelihood(group, i, response)
+        group['waiting'][i] -= 1
+        advance_rank_scan(group, sorter)
+
+def add_log_likelihood(group, i, response):
+    if response.get('noResults'):
+        return
+    _, requests = group['template']
+    info = next_move_etc(requests[0], response)
+    prior = info.get('nextMoveHumanPrior', info.get('nextMovePrior'))
+    if prior is None:
+        return
+    rank, table = group['rank_of'][i]
+    color = info['nextMoveColor'].upper()
+    likelihood = group[table][rank]
+    likelihood[color] = likelihood.get(color, 0.0) + math.log(max(prior, 1e-300))
+
+def give_up_rank_scan(i, sorter):
+    group = rank_scan_ids.get(i)
+    if group is None:
+        return
+    with rank_scan_lock:
+        rank, table = group['rank_of'][i]
+        group['waiting'][i] = 0
+        group[table].pop(rank, None)
+        advance_rank_scan(group, sorter)
+
+def advance_rank_scan(group, sorter):
+    if any(group['waiting'].values()):
+        return
+    probes = [probe_for_rank(group, r) for r in next_ranks_to_probe(group)]
+    for q in probes:
+        queue_query(q)
+    if probes:
+        return
+    ranks = next_ranks_to_analyze(group)
+    for rank in ranks:
+        katago_query, requests = cloned_query_for_rank(group, rank)
+        sorter.push_requests(requests)
+        counters['sentTurnsTotal'] += len(requests)
+        counters['sentWorkTotal'] += sum(estimated_work(req) for req in requests)
+        trace_sent([katago_query], requests)
+        queue_query(katago_query)
+    if not ranks:
+        finish_rank_scan(group)
+
+def next_ranks_to_probe(group):
+    step = group['step'] // 2
+    group['step'] = 0 if is_concentrated(group['probed']) else step
+    if group['step'] < rank_scan_min_probe_step:
+        return []
+    candidates = {r + d for r in leading_ranks(group['probed']) for d in (- step, step)}
+    return valid_ranks(candidates - set(group['probed']))
+
+def next_ranks_to_analyze(group):
+    if group['tried']:
+        leading = leading_ranks(group['analyzed'])
+        candidates = {r + d for r in leading for d in (-1, 1)}
+    else:
+        best = leading_ranks(group['probed'], mass=0)
+        candidates = {r + d for r in best for d in (-1, 0, 1)}
+    return valid_ranks(candidates - group['tried'])
+
+def valid_ranks(ranks):
+    return sorted(r for r in ranks if 0 <= r < len(humansl_ranks))
+
+def leading_ranks(table, mass=rank_scan_mass):
+    # Top ranks for each color until their posterior mass passes mass.
+    ret = set()
+    for posterior in posteriors(table):
+        total = 0.0
+        for r in sorted(posterior, key=posterior.get, reverse=True):
+            ret.add(r)
+            total += posterior[r]
+            if total >= mass:
+                break
+    return ret
+
+def is_concentrated(table):
+    return all(max(posterior.values()) >= rank_scan_mass for posterior in posteriors(table))
+
+def posteriors(table):
+    # for each color
+    from reducers import get_posterior
+    ret = []
+    for color in ['B', 'W']:
+        log_likelihood = {r: v[color] for r, v in table.items() if color in v}
+        if log_likelihood:
+            ret.append(get_posterior(log_likelihood))
+    return ret
+
+def finish_rank_scan(group):
+    for i in group['rank_of']:
+        rank_scan_ids.pop(i, None)
+    katago_query, _ = group['template']
+    rank_scan_groups.pop(katago_query['id'], None)
+
+def is_rank_scan_in_progress():
+    return bool(rank_scan_groups)
+
+def print_rank_scan_summary():
+    if not args['scan_humansl_ranks_adaptively'] or args['silent']:
+        return
+    queries = counters['rankScanQueriesTotal']
+    turns = counters['rankScanTurnsTotal']
+    full = processed_queries * len(humansl_ranks)
+    warn(f"Adaptive HumanSL rank scan: {turns} turns in {queries} queries (instead of {rank_scan_full_turns} turns in {full} queries)")
+
+##############################################
+# metrics
+
+counters = {
+    'sentTurnsTotal': 0,
+    'sentWorkTotal': 0,
+    'resumedTurnsTotal': 0,
+    'visitsTotal': 0,
+    'errorsTotal': 0,
+    'warningsTotal': 0,
+    'refinedTurnsTotal': 0,
+    'earlyStoppedTurnsTotal': 0,
+    'earlyStoppedWorkTotal': 0,
+    'rankScanQueriesTotal': 0,
+    'rankScanTurnsTotal': 0,
+    'duplicateFilesTotal': 0,
+}
+response_rate = Rate()
+visit_rate = Rate()
+work_rate = Rate()
+
+def collect_metrics(sorter):
+    waiting, pooled, to_join, done, requests = sorter.count()
+    responses = requests - waiting
+    work, buffered = sorter.cost()
+    responses_per_sec = response_rate.update(responses)
+    visits_per_sec = visit_rate.update(counters['visitsTotal'])
+    work_per_sec = work_rate.update(done_work(sorter))
+    fraction = progress_fraction(sorter)
+    resumed = counters['resumedTurnsTotal']
+    looked_up = resumed + counters['sentTurnsTotal']
+    return {
+        'elapsedSeconds': elapsed_seconds(),
+        'queriesProcessed': processed_queries,
+        'queriesToProcess': total_queries,
+        'progress': fraction,
+        'etaSeconds': eta_seconds(fraction, done_work(sorter), work_per_sec),
+        'requestsWaiting': waiting,
+        'requestsPooled': pooled,
+        'requestsToJoin': to_join,
+        'requestsDone': done,
+        'workInFlight': work if work < math.inf else None,
+        'bufferedBytes': buffered,
+        'responsesTotal': responses,
+        'responsesPerSecond': responses_per_sec,
+        'visitsPerSecond': visits_per_sec,
+        'resumeHitRatio': resumed / looked_up if looked_up else None,
+        'rssBytes': rss_bytes(),
+        **counters,
+    }
+
+def eta_seconds(fraction, done, done_per_sec):
+    if not (fraction and done_per_sec):
+        return None
+    remaining = done * (1 - fraction) / fraction
+    return remaining / done_per_sec
+
+def start_metrics(katago_process, sorter):
+    get_metrics = lambda: collect_metrics(sorter)
+    if args['metrics_socket']:
+        serve_metrics(parse_address(args['metrics_socket']), get_metrics)
+    if args['metrics'] or args['metrics_socket']:
+        # sample rates even if metrics are only served by HTTP
+        metrics_sec = 1
+        metrics_thread = threading.Thread(
+            target=update_metrics_periodically,
+            args=(metrics_sec, katago_process, sorter),
+            daemon=True,
+        )
+        metrics_thread.start()
+
+def update_metrics_periodically(sec, katago_process, sorter):
+    while in_progress(katago_process, sorter):
+        write_metrics(sorter)
+        time.sleep(sec)
+
+def write_metrics(sorter):
+    # This also samples the rates for -metrics-socket.
+    metrics = collect_metrics(sorter)
+    path = args['metrics']
+    if path is None:
+        return
+    text = to_prometheus(metrics) if path.endswith('.prom') else to_json(metrics)
+    write_atomically(path, text)
+
+##############################################
+# reducer (-reduce)
+
+# Only aggregates are kept in memory and reported at the end
+# instead of each response. See reducers.py.
+
+reducer = None
+
+def open_reducer():
+    global reducer
+    if not args['reduce']:
+        return
+    from reducers import make_reducer
+    reducer = make_reducer(args['reduce'])
+    for path in (args['reduce_load'] or '').split(','):
+        if path:
+            with open(path) as f:
+                reducer.load(jsoncodec.loads(f.read()))
+
+def reduce_responses(released):
+    if not reducer:
+        return released
+    # Released responses are used instead of pairs in Sorter
+    # so that Refiner works.
+    for r in released:
+        # joined response (-order join) has 'responses'
+        for res in r.get('responses', [r]):
+            if not is_reference(res):
+                reducer.push(res)
+    return []
+
+def finish_reducer():
+    if not reducer:
+        return
+    path = args['reduce_save']
+    if path:
+        write_atomically(path, jsoncodec.dumps(reducer.dump()))
+    for line in reducer.result_lines():
+        print_output(line)
+
+##############################################
+# latency tracing
+
+tracer = None
+
+def open_tracer():
+    global tracer
+    if args['timing_fields'] or args['trace']:
+        from latency_trace import Tracer
+        tracer = Tracer(args['trace'])
+
+def close_tracer():
+    if tracer:
+        tracer.close()
+
+def trace_sent(katago_queries, requests):
+    if not tracer:
+        return
+    for q in katago_queries:
+        turns = [req['turnNumber'] for req in requests if req['id'] == q['id']]
+        tracer.sent(q['id'], turns)
+
+def trace_arrived(response):
+    if tracer and 'turnNumber' in response:
+        tracer.arrived(response['id'], response['turnNumber'])
+
+def trace_released(released):
+    if not tracer:
+        return
+    for r in released:
+        # joined response (-order join) has 'responses'
+        for res in r.get('responses', [r]):
+            timing = tracer.released(res['id'], res['turnNumber'])
+            if timing and args['timing_fields']:
+                res['timing'] = timing
+
+##############################################
+# timing and profiling
+
+# one profiler for each thread since cProfile is per-thread
+profilers = []
+
+def profiled(func):
+    if args['profile'] is None:
+        return func
+    import cProfile
+    def wrapped(*a, **k):
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+        try:
+            return func(*a, **k)
+        finally:
+            profiler.disable()
+    return wrapped
+
+def dump_profile():
+    path = args['profile']
+    if path is None or not profilers:
+        return
+    # the response thread may be still running after interruption
+    for p in profilers:
+        p.disable()
+    import pstats
+    pstats.Stats(*profilers).dump_stats(path)
+    warn(f"Profile was written to {path} (see it by: python -m pstats {path})")
+
+def print_timing():
+    if not args['timing']:
+        return
+    print(timers.summary(), file=sys.stderr)
+
+##############################################
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Merge sorted outputs of "katawrap.py -shard I/N" into the original
+# order of the input lines and turns. Only one line per shard is kept
+# in memory at a time.
+
+import argparse
+import gzip
+import heapq
+import sys
+
+import jsoncodec
+
+##############################################
+# parse args
+
+if __name__ == "__main__":
+
+    description = """
+    Merge outputs of "katawrap.py -shard I/N -order sort" (or "-order join")
+    into one output in the original order.
+
+    (ex.)
+    katawrap_merge.py result0.jsonl result1.jsonl.gz ... > result.jsonl
+    """
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('files', metavar='FILE', nargs='+', help='output of katawrap.py with -shard (gzipped if it ends with ".gz")')
+    args = vars(parser.parse_args())
+
+##############################################
+# merge
+
+def merge(paths, out):
+    streams = [keyed_lines(path) for path in paths]
+    for key, line in heapq.merge(*streams, key=lambda z: z[0]):
+        out.write(line)
+
+def keyed_lines(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    last_key = None
+    with opener(path, mode='rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            key = sort_key(jsoncodec.loads(line), path)
+            if last_key is not None and key < last_key:
+                fail(f"Not sorted: {path} (use -order sort or join for -shard)")
+            last_key = key
+            yield (key, line)
+
+def sort_key(response, path):
+    if not 'inputIndex' in response:
+        fail(f"Missing inputIndex: {path} (use the output of katawrap.py -shard I/N)")
+    # joined response (-order join) has no turnNumber
+    turn = response.get('turnNumber', -1)
+    return (response['inputIndex'], response.get('overrideIndex', 0), turn)
+
+def fail(message):
+    print(message, file=sys.stderr)
+    exit(1)
+
+##############################################
+# run
+
+if __name__ == "__main__":
+    jsoncodec.use()
+    try:
+        merge(args['files'], sys.stdout.buffer)
+    except BrokenPipeError:
+        pass
@@ -1,5 +1,4 @@
 import copy
-import chardet
 import math
 import re
 from collections import defaultdict
@@ -13,6 +12,8 @@ class ParseError(Exception):
 
 
 class Move:
+    __slots__ = ("player", "coords")  # compact for many moves
+
     GTP_COORD = list("ABCDEFGHJKLMNOPQRSTUVWXYZ") + [
         xa + c for xa in "ABCDEFGH" for c in "ABCDEFGHJKLMNOPQRSTUVWXYZ"
     ]  # board size 52+ support
@@ -82,6 +83,8 @@ class Move:
 
 
 class SGFNode:
+    __slots__ = ("children", "properties", "_parent", "_root", "_depth", "moves_cache")  # compact for many nodes
+
     def __init__(self, parent=None, properties=None, move=None):
         self.children = []
         self.properties = defaultdict(list)
@@ -419,7 +422,12 @@ class SGF:
         match = re.search(cls.SGF_PAT, input_str)
         clipped_str = match.group() if match else input_str
         root = cls(clipped_str).root
-        # Fix weird FoxGo server KM values
+        cls._fix_foxwq_komi(root)
+        return root
+
+    @staticmethod
+    def _fix_foxwq_komi(root):
+        """Fix weird FoxGo server KM values"""
         if "foxwq" in root.get_list_property("AP", []):
             if int(root.get_property("HA", 0)) >= 1:
                 corrected_komi = 0.5
@@ -428,7 +436,6 @@ class SGF:
             else:
                 corrected_komi = 6.5
             root.set_property("KM", corrected_komi)
-        return root
 
     @classmethod
     def parse_file(cls, filename, encoding=None) -> SGFNode:
@@ -446,6 +453,8 @@ class SGF:
                     if match:
                         encoding = match[1].decode("ascii", errors="ignore")
                     else:
+                        import chardet  # only here (not needed by katawrap)
+
                         encoding = chardet.detect(bin_contents[:300])["encoding"]
                         # workaround for some compatibility issues for Windows-1252 and GB2312 encodings
                         if encoding == "Windows-1252" or encoding == "GB2312":
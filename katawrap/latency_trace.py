@@ -0,0 +1,146 @@
+import heapq
+import json
+import threading
+import time
+
+# Per-query latency tracing.
+#
+# For each query id, we record when it is sent to KataGo, when each
+# turn arrives, and when each turn is released from Sorter/Joiner.
+# "arrived - sent" is the latency of KataGo, and "released - arrived"
+# is the delay by sorting (head-of-line blocking by earlier turns).
+#
+# Optionally, events are streamed to a file in Chrome trace-event
+# format (chrome://tracing, https://ui.perfetto.dev). Each query is
+# drawn on a "lane" that is reused after the query is finished so
+# that the number of lanes is the number of queries in flight.
+
+class Tracer:
+
+    def __init__(self, trace_path=None):
+        self._origin = time.time()
+        self._queries = {}
+        self._lock = threading.Lock()
+        self._free_lanes = []
+        self._lane_count = 0
+        self._file = None
+        if trace_path is not None:
+            self._file = open(trace_path, 'w')
+            # The closing "]" is optional in trace-event format.
+            # So the file is still readable if we are killed.
+            self._file.write('[\n')
+
+    def sent(self, query_id, turns):
+        now = self._now()
+        with self._lock:
+            self._queries[query_id] = {
+                'sent': now,
+                'remaining': len(turns),
+                'arrived': {},
+                'first': None,
+                'last': None,
+                'lane': self._new_lane(),
+            }
+
+    def arrived(self, query_id, turn):
+        now = self._now()
+        with self._lock:
+            q = self._queries.get(query_id)
+            if q is None:
+                return
+            q['arrived'][turn] = now
+            if q['first'] is None:
+                q['first'] = now
+            q['last'] = now
+            self._write({'name': f'turn {turn}', 'ph': 'i', 's': 't', 'ts': micro(now), **self._where(q)})
+
+    def released(self, query_id, turn):
+        # Return {'sent': sec, 'arrived': sec, 'released': sec}
+        # where sec is the elapsed time from the start of katawrap.
+        now = self._now()
+        with self._lock:
+            q = self._queries.get(query_id)
+            if q is None:
+                return None
+            timing = {
+                'sent': q['sent'],
+                'arrived': q['arrived'].pop(turn, None),
+                'released': now,
+            }
+            q['remaining'] -= 1
+            if q['remaining'] <= 0:
+                self._finish(query_id, q, now)
+            return {k: rounded(v) for k, v in timing.items()}
+
+    def skipped(self, query_id, count):
+        # for turns that are not sent after all (-early-stop)
+        with self._lock:
+            q = self._queries.get(query_id)
+            if q is not None:
+                q['remaining'] -= count
+
+    def forget(self, query_id):
+        # for error responses
+        with self._lock:
+            q = self._queries.pop(query_id, None)
+            if q is not None:
+                self._free_lane(q['lane'])
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(metadata('process_name', 0, 'katawrap')) + '\n]\n')
+            self._file.close()
+            self._file = None
+
+    # private
+
+    def _now(self):
+        return time.time() - self._origin
+
+    def _finish(self, query_id, q, now):
+        del self._queries[query_id]
+        self._free_lane(q['lane'])
+        sent, last = q['sent'], q['last']
+        where = self._where(q)
+        self._write_span(str(query_id), sent, now, where, {
+            'firstResponse': rounded(q['first'] - sent),
+            'lastResponse': rounded(last - sent),
+        })
+        self._write_span('katago', sent, last, where)
+        self._write_span('wait', last, now, where)
+
+    def _write_span(self, name, start, end, where, args=None):
+        event = {'name': name, 'ph': 'X', 'ts': micro(start), 'dur': micro(end - start), **where}
+        if args:
+            event['args'] = args
+        self._write(event)
+
+    def _write(self, event):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(event) + ',\n')
+
+    def _where(self, q):
+        return {'pid': 0, 'tid': q['lane']}
+
+    def _new_lane(self):
+        if self._free_lanes:
+            return heapq.heappop(self._free_lanes)
+        lane = self._lane_count
+        self._lane_count += 1
+        self._write(metadata('thread_name', lane, f'lane {lane}'))
+        return lane
+
+    def _free_lane(self, lane):
+        heapq.heappush(self._free_lanes, lane)
+
+def metadata(name, tid, value):
+    return {'name': name, 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': value}}
+
+def micro(sec):
+    return round(sec * 1e6)
+
+def rounded(sec):
+    return None if sec is None else round(sec, 4)
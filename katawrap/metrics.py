@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+# Machine-readable metrics for dashboards and alerting.
+# Metrics are given as a flat dict like {'responsesTotal': 123, ...}
+# and rendered as JSON or Prometheus text exposition format.
+# Keys that end with "Total" are counters. Others are gauges.
+# None values are omitted in Prometheus format.
+
+def to_json(metrics):
+    return json.dumps(metrics, indent=1) + '\n'
+
+def to_prometheus(metrics, prefix='katawrap_'):
+    lines = []
+    for key, value in metrics.items():
+        if value is None:
+            continue
+        name = prefix + snake_case(key)
+        kind = 'counter' if key.endswith('Total') else 'gauge'
+        lines += [f"# TYPE {name} {kind}", f"{name} {number(value)}"]
+    return '\n'.join(lines) + '\n'
+
+def number(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def snake_case(camel):
+    return re.sub(r'([A-Z])', lambda m: '_' + m.group(1).lower(), camel)
+
+def write_atomically(path, text):
+    # so that a scraper never sees a partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def rss_bytes():
+    # current RSS on Linux (None elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+##############################################
+# rate
+
+class Rate:
+
+    # rate of increase of a counter over the last "window" seconds
+
+    def __init__(self, window=10.0):
+        self._window = window
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def update(self, value):
+        now = time.time()
+        with self._lock:
+            samples = self._samples
+            samples.append((now, value))
+            while len(samples) > 2 and now - samples[1][0] >= self._window:
+                samples.popleft()
+            (t0, v0), (t1, v1) = samples[0], samples[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else None
+
+##############################################
+# HTTP
+
+def serve_metrics(address, get_metrics):
+    # GET /metrics => Prometheus text, GET /metrics.json => JSON
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # slow to import
+    host, port = address
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/metrics.json'):
+                body, content_type = to_json(get_metrics()), 'application/json'
+            elif self.path.startswith('/metrics'):
+                body, content_type = to_prometheus(get_metrics()), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        def log_message(self, *args):
+            pass  # keep stderr for progress
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def parse_address(s, default_host='127.0.0.1'):
+    # "HOST:PORT" or "PORT"
+    host, _, port = s.rpartition(':')
+    return (host or default_host, int(port))
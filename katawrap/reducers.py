@@ -0,0 +1,208 @@
+import csv
+import io
+import json
+import math
+import re
+from collections import defaultdict
+
+# Reducers aggregate responses in katawrap itself so that the full
+# responses need not be written and parsed again (-reduce NAME:K=V,...).
+# Each reducer has:
+#   push(response): called for each cooked response
+#   result_lines(): final output
+#   dump() / load(dumped): JSON-able aggregates for checkpoints.
+#     Loading several dumps merges them (e.g. outputs of -shard).
+
+##############################################
+# estimate_rank (same as sample/estimate_rank.py)
+
+fields_spec = {
+    'file': {
+        'agg': ['sgfFile', 'nextMoveColor'],
+        'out': [
+            'sgfFile', 'nextMoveColor',
+            'PB', 'BR', 'PW', 'WR', 'RE', 'HA', 'KM', 'DT', 'SZ', 'TM',
+            'player', 'playerRank',
+        ],
+    },
+    'player': {
+        'agg': ['player'],
+        'out': ['player'],
+    },
+    'player+rank': {
+        'agg': ['player', 'playerRank'],
+        'out': ['player', 'playerRank'],
+    },
+}
+
+csv_output_fields = ['sgfFile', 'nextMoveColor', 'player', 'playerRank']
+
+class EstimateRank:
+
+    name = 'estimate_rank'
+
+    def __init__(self, by='file', output='csv'):
+        if not by in fields_spec:
+            raise ValueError(f'Invalid by={by} for estimate_rank. Allowed options are: {", ".join(fields_spec)}')
+        if not output in ('csv', 'json'):
+            raise ValueError(f'Invalid output={output} for estimate_rank. Allowed options are: csv, json')
+        self._by = by
+        self._output = output
+        self._result = {}
+
+    def push(self, response):
+        add_player_info(response)
+        update_result(self._result, response, self._by)
+
+    def result_lines(self):
+        return [line_for(record, self._by, self._output) for record in self._result.values()]
+
+    def dump(self):
+        return dump_result(self._result, self._by)
+
+    def load(self, dumped):
+        load_result(self._result, dumped, self._by)
+
+# The functions below are also used by sample/estimate_rank.py.
+# result = {key: record} where key is the values of fields_spec[by]['agg'].
+
+def add_player_info(d):
+    c = d.get('nextMoveColor')
+    if c == 'B':
+        d.update({'player': d.get('PB'), 'playerRank': d.get('BR')})
+    elif c == 'W':
+        d.update({'player': d.get('PW'), 'playerRank': d.get('WR')})
+
+def update_result(result, analysis, by):
+    # ignore analysis after the last move
+    if analysis.get('nextMovePrior') is None and analysis.get('nextMoveHumanPrior') is None:
+        return
+    key = key_of(analysis, by)
+    record = result.get(key)
+    if record is None:
+        record = result[key] = new_record(analysis, by)
+    update_record(record, analysis)
+
+def key_of(analysis, by):
+    return tuple(analysis.get(k) for k in fields_spec[by]['agg'])
+
+def new_record(analysis, by):
+    return {
+        **{k: analysis.get(k) for k in fields_spec[by]['out']},
+        'log_likelihood': defaultdict(float),
+        'moves': defaultdict(int),
+    }
+
+def update_record(record, analysis):
+    profile = analysis['humanSLProfile']
+    prior = analysis.get('nextMoveHumanPrior')
+    if prior is None:
+        prior = analysis['nextMovePrior']
+    record['log_likelihood'][profile] += math.log(prior)
+    record['moves'][profile] += 1
+
+def merge_result(result, partial):
+    for key, record in partial.items():
+        r = result.get(key)
+        if r is None:
+            result[key] = record
+            continue
+        for profile, v in record['log_likelihood'].items():
+            r['log_likelihood'][profile] += v
+        for profile, n in record['moves'].items():
+            r['moves'][profile] += n
+
+# partial aggregates (-reduce-save, estimate_rank.py -save-partial)
+
+def dump_result(result, by):
+    records = [
+        {**{k: v for k, v in r.items() if k not in ('log_likelihood', 'moves')},
+         'logLikelihood': r['log_likelihood'], 'moves': r['moves']}
+        for r in result.values()
+    ]
+    return {'reducer': EstimateRank.name, 'by': by, 'records': records}
+
+def load_result(result, dumped, by):
+    if dumped.get('reducer') != EstimateRank.name or dumped.get('by') != by:
+        raise ValueError(f"Incompatible aggregates: reducer={dumped.get('reducer')}, by={dumped.get('by')}")
+    partial = {}
+    for d in dumped['records']:
+        record = new_record(d, by)
+        record['log_likelihood'].update(d['logLikelihood'])
+        record['moves'].update(d['moves'])
+        partial[key_of(d, by)] = record
+    merge_result(result, partial)
+
+# output
+
+def line_for(record, by, output):
+    # without newline
+    log_likelihood = record['log_likelihood']
+    posterior = get_posterior(log_likelihood)
+    estimated_rank = dict_argmax(log_likelihood)
+    output_fields = fields_spec[by]['out']
+    player_dan = dan_for(record.get('playerRank'))
+    estimated_dan = dan_for(estimated_rank)
+    if output == 'json':
+        return json.dumps({
+            **{k: record.get(k) for k in output_fields},
+            'estimatedRank': estimated_rank,
+            'posteriorOfEstimatedRank': posterior[estimated_rank],
+            'movesForEstimatedRank': record['moves'][estimated_rank],
+            'playerDan': player_dan,
+            'estimatedDan': estimated_dan,
+            'errorOfestimatedDan': estimated_dan - player_dan,
+            'posterior': posterior,
+        })
+    a = [record.get(k) for k in intersection(output_fields, csv_output_fields)]
+    r = [estimated_rank]
+    buf = io.StringIO()
+    csv.writer(buf, delimiter=',').writerow(a + r)
+    return buf.getvalue()[:-1]  # keep '\r' as csv.writer on STDOUT
+
+def get_posterior(log_likelihood):
+    # Uniform prior is assumed.
+    m = max(log_likelihood.values())
+    unnormalized_posterior = {k: math.exp(v - m) for k, v in log_likelihood.items()}
+    s = sum(unnormalized_posterior.values())
+    return {k: v / s for k, v in unnormalized_posterior.items()}
+
+def intersection(a, b):
+    # keep order
+    return [x for x in a if x in b]
+
+def dict_argmax(d):
+    return max(d, key=d.get)
+
+def dan_for(rank):
+    nan = float('nan')
+    if rank is None:
+        return nan
+    match = re.search(r'(\d+)([dkp])', rank)
+    if match:
+        n = int(match.group(1))
+        u = match.group(2)
+        return n if u == 'd' else 1 - n if u == 'k' else 9
+    else:
+        return nan
+
+##############################################
+# registry
+
+reducers = {
+    EstimateRank.name: EstimateRank,
+}
+
+def make_reducer(spec):
+    # "NAME:K1=V1,K2=V2"
+    name, _, options = spec.partition(':')
+    if not name in reducers:
+        raise ValueError(f'Unknown reducer "{name}". Available reducers are: {", ".join(reducers)}')
+    pairs = [kv.split('=', 1) for kv in options.split(',') if kv]
+    invalid = [kv for kv in pairs if len(kv) != 2]
+    if invalid:
+        raise ValueError(f'Invalid option "{invalid[0][0]}" for {name} (K=V is expected)')
+    try:
+        return reducers[name](**dict(pairs))
+    except TypeError:
+        raise ValueError(f'Unknown option in "{options}" for {name}')
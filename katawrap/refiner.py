@@ -0,0 +1,92 @@
+from util import find_if
+
+# Refiner sits between Sorter and Joiner for two-pass analysis.
+#
+# Pairs come from Sorter in order. Each pair is "critical" if
+# is_critical(pair) is true, or if is_critical_pair(pair, next_pair)
+# is true for successive turns (in which case both are critical).
+# A critical pair is sent to refine(pair) that re-queries KataGo with
+# more visits, and it is held until push_refined_response() replaces
+# its response. Later pairs are also held to keep the order.
+
+class Refiner:
+
+    def __init__(self, refine, is_critical=None, is_critical_pair=None, finished=None):
+        self._refine = refine
+        self._is_critical = is_critical or (lambda pair: False)
+        self._is_critical_pair = is_critical_pair or (lambda former, latter: False)
+        self._finished = finished or (lambda query_id: None)
+        self._pool = []
+
+    def count(self):
+        return len(self._pool)
+
+    def is_refining(self):
+        return any(e['refining'] for e in self._pool)
+
+    def push_pairs(self, pairs):
+        for pair in pairs:
+            self._push_pair(pair)
+        return self._pop_ready_pairs()
+
+    def push_refined_response(self, query_id, turn, response, cook=None):
+        # response = None for giving up refinement (e.g. error)
+        entry = find_if(self._pool, lambda e: e['refining'] and key_of(e['pair']) == (query_id, turn))
+        if entry is None:
+            return []
+        if response is not None:
+            req, _ = entry['pair']
+            if cook:
+                cook(req, response)
+            entry['pair'] = (req, response)
+        entry['refining'] = False
+        return self._pop_ready_pairs()
+
+    def give_up(self, query_id):
+        # The rest of turns will never come after error.
+        # Drop the held pairs of the query (including ones under refinement).
+        self._pool = [e for e in self._pool if key_of(e['pair'])[0] != query_id]
+        self._finished(query_id)
+
+    # private
+
+    def _push_pair(self, pair):
+        entry = {'pair': pair, 'critical': self._is_critical(pair), 'decided': False, 'refining': False}
+        prev = self._pool[-1] if self._pool else None
+        if prev and not prev['decided']:
+            if is_successive(prev['pair'], pair) and self._is_critical_pair(prev['pair'], pair):
+                prev['critical'] = entry['critical'] = True
+            self._decide(prev)
+        self._pool.append(entry)
+        if not needs_next_pair(pair):
+            self._decide(entry)
+
+    def _decide(self, entry):
+        entry['decided'] = True
+        if entry['critical']:
+            entry['refining'] = True
+            self._refine(entry['pair'])
+
+    def _pop_ready_pairs(self):
+        ready = []
+        for e in self._pool:
+            if not e['decided'] or e['refining']:
+                break
+            ready.append(e['pair'])
+        del self._pool[:len(ready)]
+        for req, res in ready:
+            if res['turnNumber'] == req['analyzeTurns'][-1]:
+                self._finished(req['id'])
+        return ready
+
+def key_of(pair):
+    req, _ = pair
+    return (req['id'], req['turnNumber'])
+
+def is_successive(former, latter):
+    (id0, turn0), (id1, turn1) = key_of(former), key_of(latter)
+    return id0 == id1 and turn0 + 1 == turn1
+
+def needs_next_pair(pair):
+    req, res = pair
+    return (res['turnNumber'] + 1) in req['analyzeTurns']
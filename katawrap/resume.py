@@ -0,0 +1,62 @@
+import os
+
+import jsoncodec
+from block_gzip import read_members
+
+# Scan partial output of an interrupted run and find completed turns.
+# The incomplete tail (a broken last line or gzip member) is truncated
+# so that new responses can be appended to the file directly.
+
+def completed_turns(path):
+    if not os.path.exists(path):
+        return set()
+    lines = scan_gzip(path) if path.endswith('.gz') else scan_text(path)
+    done = set()
+    for line in lines:
+        done.update(turns_in_line(line))
+    return done
+
+def turns_in_line(line):
+    try:
+        response = jsoncodec.loads(line)
+    except ValueError:
+        return []
+    # joined response for -order join
+    responses = response.get('responses') or [response]
+    return [
+        (res.get('id'), res.get('turnNumber'))
+        for res in responses
+        if 'turnNumber' in res
+    ]
+
+# plain text
+
+def scan_text(path):
+    truncate_incomplete_line(path)
+    with open(path, 'rb') as f:
+        yield from f
+
+def truncate_incomplete_line(path, block_size=65536):
+    # search the last newline from the tail
+    with open(path, 'rb+') as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            k = f.read(pos - start).rfind(b'\n')
+            if k >= 0:
+                f.truncate(start + k + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+# gzip
+
+def scan_gzip(path):
+    complete = 0
+    for offset, data in read_members(path):
+        complete = offset
+        yield from data.splitlines()
+    # drop the broken last member if any
+    with open(path, 'rb+') as f:
+        f.truncate(complete)
@@ -0,0 +1,89 @@
+import re
+
+# Split SGF collection files "(;...)(;...)..." into game trees without
+# reading the whole file at once. Only parentheses outside property
+# values are counted, so that "(" and ")" in comments are ignored.
+# A game tree starts with "(;" (whitespace is allowed between them), and
+# texts between game trees are dropped even if they include "(".
+#
+# read_game() keeps the position in the last file so that games are read
+# sequentially when they are requested in order.
+
+chunk_size = 1024 * 1024
+# text without parentheses (property values may include them)
+skip_pat = re.compile(rb'(?:[^()\[]+|\[[^\]\\]*(?:\\.[^\]\\]*)*\])*', flags=re.DOTALL)
+open_paren, open_bracket = b'(['
+game_start_pat = re.compile(rb'\(\s*;')
+partial_start_pat = re.compile(rb'\(\s*\Z')  # may be completed by the next chunk
+
+def split_games(chunks):
+    # Yield each game tree as bytes from the iterable of byte chunks.
+    buf = b''
+    start = None  # start of the current game in buf
+    pos = 0
+    depth = 0
+    for chunk in chunks:
+        keep = pos if start is None else start
+        buf = buf[keep:] + chunk
+        pos -= keep
+        if start is not None:
+            start = 0
+        while True:
+            if depth == 0:
+                m = game_start_pat.search(buf, pos)
+                if m is None:
+                    partial = partial_start_pat.search(buf, pos)
+                    start, pos = None, (partial.start() if partial else len(buf))
+                    break
+                start = m.start()
+                pos, depth = start + 1, 1
+            pos = skip_pat.match(buf, pos).end()
+            if pos == len(buf) or buf[pos] == open_bracket:
+                break  # wait for the rest of the property value
+            depth += 1 if buf[pos] == open_paren else -1
+            pos += 1
+            if depth == 0:
+                yield buf[start:pos]
+                start = None
+    if start is not None:
+        yield buf[start:]  # unterminated
+
+def read_chunks(f):
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def count_games(f):
+    # f = binary file object (closed after counting)
+    return sum(1 for _ in split_games(read_chunks(f)))
+
+# (path, games, index of the next game, the last game)
+reader = (None, None, 0, None)
+
+def read_game(path, index, opener):
+    # Return the index-th game (from 0) in path as bytes, or None if missing.
+    # opener(path) must return a binary file object.
+    global reader
+    cur_path, games, next_index, last_game = reader
+    if cur_path == path and index == next_index - 1:
+        return last_game  # for -override-list etc.
+    if cur_path != path or index < next_index:
+        close_reader()
+        games, next_index = split_games(read_chunks(opener(path))), 0
+    reader = (None, None, 0, None)
+    for game in games:
+        k, next_index = next_index, next_index + 1
+        if k == index:
+            reader = (path, games, next_index, game)
+            return game
+    return None
+
+def close_reader():
+    global reader
+    games = reader[1]
+    if games is not None:
+        games.close()  # close the file
+    reader = (None, None, 0, None)
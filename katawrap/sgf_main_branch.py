@@ -0,0 +1,76 @@
+import re
+
+from katrain.sgf_parser import SGF, SGFNode
+
+# Fast replacement of SGF.parse_sgf for katawrap, which uses only the
+# main branch (children[0] of each node).
+#
+# The main branch always goes into the first variation. So it ends at
+# the first ')' and we can stop there without parsing other variations.
+# Non-root nodes keep only the properties for moves and setup stones,
+# so that comments etc. are not unescaped or stored. The same SGFNode
+# is used for the result. SGF.parse_sgf is used as fallback for unusual
+# cases where the result may differ (or it raises ParseError).
+# Properties are added without _clear_cache since nothing is cached yet.
+#
+# Note that errors after the main branch are not detected.
+
+kept_properties = {'B', 'W', 'AB', 'AW'}
+value_separator = re.compile(r"\]\s*\[")
+
+def parse_main_branch(sgf):
+    root = try_parse_main_branch(sgf)
+    return SGF.parse_sgf(sgf) if root is None else root
+
+def try_parse_main_branch(sgf):
+    # Return None for fallback.
+    # This follows SGF.parse_sgf, SGF.__init__, and SGF._parse_branch.
+    clipped = SGF.SGF_PAT.search(sgf)
+    contents = clipped.group() if clipped else sgf
+    start = contents.find('(')
+    if start < 0:
+        return None
+    root = current = SGF._NODE_CLASS()
+    empty = True  # = current.empty without counting dropped properties
+    match_token = SGF.SGFPROP_PAT.match
+    ix, end = start + 1, len(contents)
+    while ix < end:
+        match = match_token(contents, ix)
+        if not match:
+            return None
+        ix = match.end()
+        prop = match[1]
+        if prop is not None:
+            empty = False
+            prop = normalized_property(prop)
+            if current is root or prop in kept_properties:
+                current.properties[prop] += property_values(match[2])
+            continue
+        token = match[0][-1]
+        if token == ')':
+            break
+        if token == '(':
+            current, empty = SGF._NODE_CLASS(parent=current), True
+        elif not (empty or is_last_node(contents, ix)):  # token == ';'
+            current, empty = SGF._NODE_CLASS(parent=current), True
+    else:
+        return None  # no ')'
+    SGF._fix_foxwq_komi(root)
+    if root.children and not any(c in root.children[0].properties for c in 'BW'):
+        return None  # initial_player looks at other variations
+    return root
+
+def property_values(text):
+    # as SGF._parse_branch (_unescape_value only changes values with '\\')
+    values = value_separator.split(text.strip()[1:-1])
+    return [SGFNode._unescape_value(v) for v in values] if '\\' in text else values
+
+def is_last_node(contents, ix):
+    # ";)" at the end is ignored for old SGF
+    # (= contents[ix:].strip() == ")" without copying the rest every time)
+    rest = contents.find(')', ix)
+    return rest >= 0 and not contents[ix:rest].strip() and not contents[rest + 1:].strip()
+
+def normalized_property(prop):
+    # SiZe[19] ==> SZ[19] etc. for old SGF (as SGFNode.add_list_property)
+    return prop if prop.isupper() else re.sub("[a-z]", "", prop)
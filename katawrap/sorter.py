@@ -1,7 +1,11 @@
-import json
+import jsoncodec
+import math
+import time
 
-from util import find_if, nop
+from collections import deque
+from util import nop
 from joiner import Joiner
+from refiner import Refiner
 
 class Sorter:
 
@@ -9,62 +13,158 @@ class Sorter:
             self,
             sort=True,
             max_requests=1000,
-            corresponding=nop,
+            key_of=None,
             error_reporter=nop,
+            # cost-aware limits
+            max_work=math.inf,
+            max_buffer=math.inf,
+            work_of=None,
+            size_of=None,
+            auto_limit=False,
+            # for refiner (two-pass analysis)
+            refine=None,
+            is_critical=None,
+            is_critical_pair=None,
+            refine_finished=None,
             # for joiner
             join_pairs=None,
             cook_successive_pairs=None
     ):
         self._sort = sort
         self._max_requests = max_requests
-        self._corresponding = corresponding
+        # Requests and responses are matched by key_of (e.g. id and turnNumber).
+        # The k-th request and the k-th response of the same key correspond.
+        self._key_of = key_of or (lambda z: (z.get('id'), z.get('turnNumber')))
         self._error_reporter = error_reporter
-        self._req_pool = []
-        self._res_pool = []
+        self._req_pool = Pool(self._key_of)  # in the order of requests
+        self._res_pool = Pool(self._key_of)  # in the order of arrival
+        self._refiner = refine and Refiner(
+            refine,
+            is_critical=is_critical,
+            is_critical_pair=is_critical_pair,
+            finished=refine_finished,
+        )
         self._joiner = Joiner(
             join_pairs=join_pairs,
-            cook_successive_pairs=cook_successive_pairs
+            cook_successive_pairs=cook_successive_pairs,
+            size_of=size_of,
         )
+        # "work" = estimated cost of requests that are not answered yet
+        # "buffer" = estimated size of answered but unreleased responses
+        self._max_work = max_work
+        self._max_buffer = max_buffer
+        self._work_of = work_of or (lambda req: 0)
+        self._size_of = size_of or (lambda req: 0)
+        self._work = 0
+        self._pooled_size = 0
+        self._unsent = set()  # id() of requests that are not sent to the engine yet
+        self._auto_limit = AutoLimit(max_work) if auto_limit else None
+        if self._auto_limit:
+            self._max_work = self._auto_limit.limit
 
     def has_requests(self):
-        return bool(self._req_pool)
+        refining = self._refiner and self._refiner.count() > 0
+        return bool(self._req_pool) or bool(refining)
 
     def has_room(self):
-        return len(self._req_pool) < self._max_requests
+        if not self._req_pool:
+            return True  # avoid deadlock for a single huge query
+        return (
+            len(self._req_pool) - len(self._unsent) < self._max_requests
+            and self._work < self._max_work
+            and self._buffered_size() < self._max_buffer
+        )
+
+    def _buffered_size(self):
+        return self._pooled_size + self._joiner.size()
+
+    def cost(self):
+        return (self._work, self._buffered_size())
 
     def count(self):
         requests = len(self._req_pool)
-        pooled = len(self._res_pool)
-        waiting = requests - pooled
+        pooled = len(self._res_pool) + (self._refiner.count() if self._refiner else 0)
+        waiting = requests - len(self._res_pool)
         to_join, popped = self._joiner.count()
         counts = [waiting, pooled, to_join, popped]
         pushed = sum(counts)
         return (waiting, pooled, to_join, popped, pushed)
 
-    def push_requests(self, requests):
-        self._req_pool += requests
+    def push_requests(self, requests, is_unsent=None):
+        # Requests for which is_unsent(req) is true (e.g. later chunks of
+        # -early-stop) are not counted as pending work until mark_sent_by_id.
+        for req in requests:
+            self._req_pool.add(req)
+            if is_unsent and is_unsent(req):
+                self._unsent.add(id(req))
+            else:
+                self._work += self._work_of(req)
+
+    def mark_sent_by_id(self, i, turns):
+        for req in self._req_pool.values():
+            if req['id'] == i and req['turnNumber'] in turns and id(req) in self._unsent:
+                self._unsent.remove(id(req))
+                self._work += self._work_of(req)
 
-    def push_response(self, response):
-        self._res_pool.append(response)
+    def push_response(self, response, req=None):
+        # req = request for response if it is already known
+        req = req or self._get_request_for(response)
+        if req:
+            work = self._work_of(req)
+            self._work -= work
+            self._pooled_size += self._size_of(req)
+            if self._auto_limit:
+                self._max_work = self._auto_limit.update(work)
+        self._res_pool.add(response)
         return self._pop_req_res_pairs()
 
     def push_pairs_to_joiner(self, pairs):
+        if self._refiner:
+            pairs = self._refiner.push_pairs(pairs)
+        return self._joiner.push_pairs(pairs)
+
+    def push_refined_response(self, query_id, turn, response, cook=None):
+        pairs = self._refiner.push_refined_response(query_id, turn, response, cook)
         return self._joiner.push_pairs(pairs)
 
     def get_request_for(self, res):
         return self._get_request_for(res)
 
-    def pop_requests_by_id(self, i):
-        requests = [req for req in self._req_pool if req['id'] == i]
+    def pop_requests_by_id(self, i, turns=None):
+        # all requests for the id if turns is None
+        # (= give up the query after error. Its answered turns that are
+        # not released yet are also dropped. Call pop_pairs() then.)
+        requests = [
+            req for req in self._req_pool.values()
+            if req['id'] == i and (turns is None or req['turnNumber'] in turns)
+        ]
+        if turns is None:
+            if self._refiner:
+                self._refiner.give_up(i)
+            self._joiner.give_up(i)
         for req in requests:
+            res = self._get_response_for(req)
+            if id(req) in self._unsent:
+                self._unsent.remove(id(req))
+            elif res is None:
+                self._work -= self._work_of(req)
+            elif turns is None:
+                self._res_pool.remove(res)
+                self._pooled_size -= self._size_of(req)
             self._req_pool.remove(req)
         return requests
 
+    def pop_pairs(self):
+        # Pairs may be ready without a new response after pop_requests_by_id.
+        return self._pop_req_res_pairs()
+
     def dump_requests(self):
-        return ''.join([json.dumps(h) + '\n' for h in self._req_pool])
+        return ''.join([jsoncodec.dumps(h) + '\n' for h in self._req_pool.values()])
 
     def undump_requests(self, dumped):
-        self._req_pool = [json.loads(s) for s in dumped.strip().split('\n')]
+        self._req_pool = Pool(self._key_of)
+        for s in dumped.strip().split('\n'):
+            self._req_pool.add(jsoncodec.loads(s))
 
     # available request-response pairs
 
@@ -78,6 +178,8 @@ class Sorter:
                 self._req_pool.remove(req)
             if res:
                 self._res_pool.remove(res)
+            if req and res:
+                self._pooled_size -= self._size_of(req)
         invalid_pairs = [p for p in pairs if not all(p)]
         for p in invalid_pairs:
             req, res = p
@@ -86,12 +188,15 @@ class Sorter:
         return pairs
 
     def _get_pairs_in_arrival_order(self):
-        return [(self._get_request_for(res), res) for res in self._res_pool]
+        seen = {}
+        return [(self._req_pool.nth(res, self._count(seen, res)), res)
+                for res in self._res_pool.values()]
 
     def _get_available_sorted_pairs(self):
         ret = []
-        for req in self._req_pool:
-            res = self._get_response_for(req)
+        seen = {}
+        for req in self._req_pool.values():
+            res = self._res_pool.nth(req, self._count(seen, req))
             if res:
                 ret.append((req, res))
             else:
@@ -102,10 +207,85 @@ class Sorter:
     # correspondence
 
     def _get_request_for(self, res):
-        return self._find_correspondence(self._req_pool, res)
+        return self._req_pool.nth(res, 0)
 
     def _get_response_for(self, req):
-        return self._find_correspondence(self._res_pool, req)
+        return self._res_pool.nth(req, self._req_pool.index(req))
+
+    def _count(self, seen, z):
+        # occurrences of the key of z so far in a pass
+        key = self._key_of(z)
+        k = seen.get(key, 0)
+        seen[key] = k + 1
+        return k
+
+# Elements in the order of addition with an index by key_of so that
+# lookup and removal do not scan all pending turns under heavy reordering.
+# Elements of the same key are kept in the order of addition.
+
+class Pool:
+
+    def __init__(self, key_of):
+        self._key_of = key_of
+        self._elements = {}  # serial => element
+        self._serials = {}  # key => deque of serials
+        self._next_serial = 0
+
+    def __len__(self):
+        return len(self._elements)
+
+    def values(self):
+        return self._elements.values()
+
+    def add(self, z):
+        serial = self._next_serial
+        self._next_serial += 1
+        self._elements[serial] = z
+        self._serials.setdefault(self._key_of(z), deque()).append(serial)
+
+    def nth(self, like, k):
+        # k-th element of the same key as like (None if not found)
+        serials = self._serials.get(self._key_of(like), ())
+        return self._elements[serials[k]] if k < len(serials) else None
+
+    def index(self, z):
+        serials = self._serials.get(self._key_of(z), ())
+        return next((k for k, s in enumerate(serials) if self._elements[s] is z), None)
+
+    def remove(self, z):
+        key = self._key_of(z)
+        serials = self._serials[key]
+        serial = next(s for s in serials if self._elements[s] is z)
+        serials.remove(serial)
+        if not serials:
+            del self._serials[key]
+        del self._elements[serial]
+
+# Adjust max_work so that the engine always has enough work queued.
+# If the limit is too small, the throughput is proportional to the limit
+# and the limit grows. Otherwise, it converges to 2 * horizon seconds
+# of work.
+
+class AutoLimit:
+
+    def __init__(self, initial, horizon=5.0, interval=1.0, minimum=1000):
+        self.limit = initial if initial < math.inf else minimum * 10
+        self._horizon = horizon
+        self._interval = interval
+        self._minimum = minimum
+        self._done = 0
+        self._rate = None
+        self._last_time = time.time()
 
-    def _find_correspondence(self, lis, elt):
-        return find_if(lis, lambda z: self._corresponding(z, elt))
+    def update(self, done_work):
+        self._done += done_work
+        now = time.time()
+        dt = now - self._last_time
+        if dt < self._interval:
+            return self.limit
+        rate = self._done / dt
+        self._rate = rate if self._rate is None else (self._rate + rate) / 2
+        self._done = 0
+        self._last_time = now
+        self.limit = max(self._minimum, 2 * self._rate * self._horizon)
+        return self.limit
@@ -0,0 +1,123 @@
+import math
+import threading
+import time
+
+# Lightweight timers for each stage of processing.
+# Durations are recorded into logarithmic histograms so that
+# percentiles are available with constant memory.
+
+class Timers:
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def timed(self, name):
+        return _Timed(self, name)
+
+    def decorate(self, name):
+        def decorator(func):
+            def wrapped(*args, **kwargs):
+                with _Timed(self, name):
+                    return func(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def add(self, name, seconds):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = Histogram()
+            stage.add(seconds)
+
+    def summary(self):
+        with self._lock:
+            stages = list(self._stages.items())
+        header = f"{'stage':24} {'count':>9} {'total':>9} {'p50':>9} {'p95':>9} {'p99':>9}"
+        lines = [header] + [
+            f"{name:24} {h.count:9} {h.total:8.3f}s "
+            f"{format_ms(h.percentile(50))} {format_ms(h.percentile(95))} {format_ms(h.percentile(99))}"
+            for name, h in sorted(stages, key=lambda z: - z[1].total)
+        ]
+        return '\n'.join(lines)
+
+# No-op version for runs without -timing so that each stage does not
+# pay for the lock and the histogram.
+
+class NullTimers:
+
+    def timed(self, name):
+        return _null_timed
+
+    def decorate(self, name):
+        return lambda func: func
+
+    def add(self, name, seconds):
+        pass
+
+    def summary(self):
+        return ''
+
+class _NullTimed:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_timed = _NullTimed()
+
+class _Timed:
+
+    __slots__ = ('_timers', '_name', '_start')
+
+    def __init__(self, timers, name):
+        self._timers = timers
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._timers.add(self._name, time.perf_counter() - self._start)
+        return False
+
+class Histogram:
+
+    # 8 buckets per octave from 1 microsecond (about 9% resolution)
+    _per_octave = 8
+    _origin = 1e-6
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self._buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        k = self._bucket(seconds)
+        self._buckets[k] = self._buckets.get(k, 0) + 1
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for k in sorted(self._buckets):
+            seen += self._buckets[k]
+            if seen >= rank:
+                return self._origin * 2 ** ((k + 0.5) / self._per_octave)
+        return 0.0
+
+    def _bucket(self, seconds):
+        if seconds <= self._origin:
+            return 0
+        return int(math.log2(seconds / self._origin) * self._per_octave)
+
+def format_ms(seconds):
+    return f"{seconds * 1000:7.2f}ms"
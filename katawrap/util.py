@@ -1,7 +1,8 @@
-import json
 import sys
 import os
 
+import jsoncodec
+
 def find_if(lis, pred):
     hit = [z for z in lis if pred(z)]
     return hit[0] if hit else None
@@ -19,7 +20,7 @@ def warn(message, overwrite=False):
 
 def parse_json(s):
     try:
-        return json.loads(s)
+        return jsoncodec.loads(s)
     except:
         warn(f"Invalid JSON '{s}' is replaced with '{{}}')")
         return {}
@@ -31,5 +32,15 @@ def merge_dict(*args):
         ret.update(d)
     return ret
 
+def count_lines(path, block_size=1024**2):
+    # fast enough for huge files without holding them in memory
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    return count if last == b'\n' else count + 1
+
 def is_executable(path):
     return os.path.exists(path) and bool(os.stat(path).st_mode & 0o111)
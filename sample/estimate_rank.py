@@ -3,13 +3,22 @@
 # Avoid using pandas to prevent running out of memory with large inputs.
 
 import sys
+import os
+import gzip
 import json
-import math
 import argparse
-import csv
-import re
-from collections import defaultdict
 from datetime import datetime
+from multiprocessing import Pool
+
+# shared with "katawrap.py -reduce estimate_rank"
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'katawrap'))
+from reducers import fields_spec, add_player_info, update_result, merge_result, dump_result, load_result, line_for
+
+try:
+    # faster if installed (pip install orjson)
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 ##############################################
 # parse
@@ -43,36 +52,31 @@ compressing them is recommended.
   ls /FOO/*.sgf | /BAR/katawrap.py ... \\
     | jq -c '{sgfFile, nextMoveColor, turnNumber, humanSLProfile, nextMovePrior, PB, BR, PW, WR, RE, HA, KM, DT, SZ, TM}' \\
     | gzip > analysis.jsonl.gz
-  zcat analysis.jsonl.gz | ./estimate_rank.py""",
+  zcat analysis.jsonl.gz | ./estimate_rank.py
+
+Large inputs can be given as files (gzipped if they end with ".gz").
+They are processed in parallel.
+  ./estimate_rank.py analysis1.jsonl analysis2.jsonl.gz ...
+
+Partial aggregates can be saved and merged later, e.g. for nightly runs.
+(They are compatible with "katawrap.py -reduce-save".)
+  ./estimate_rank.py -save-partial day1.json day1.jsonl.gz > /dev/null
+  ./estimate_rank.py -merge day1.json -save-partial day2.json day2.jsonl.gz""",
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument('-by', metavar='AGG', help='aggregate results by: "file" (default), "player", or "player+rank"', required=False)
     parser.add_argument('-json', action='store_true', help='output JSONL with additional information.')
+    parser.add_argument('-jobs', metavar='N', type=int, help='number of processes for FILE (default: number of CPUs)', default=os.cpu_count() or 1)
+    parser.add_argument('-save-partial', metavar='PATH', help='save partial aggregates to PATH as JSON', default=None)
+    parser.add_argument('-merge', metavar='PATH', action='append', help='merge partial aggregates saved by -save-partial (can be repeated)', default=[])
+    parser.add_argument('files', metavar='FILE', nargs='*', help='output of katawrap (read STDIN if no FILE and no -merge)')
     args = vars(parser.parse_args())
 
 ################################################
 # constants
 
-fields_spec = {
-    'file': {
-        'agg': ['sgfFile', 'nextMoveColor'],
-        'out': [
-            'sgfFile', 'nextMoveColor',
-            'PB', 'BR', 'PW', 'WR', 'RE', 'HA', 'KM', 'DT', 'SZ', 'TM',
-            'player', 'playerRank',
-        ],
-    },
-    'player': {
-        'agg': ['player'],
-        'out': ['player'],
-    },
-    'player+rank': {
-        'agg': ['player', 'playerRank'],
-        'out': ['player', 'playerRank'],
-    },
-}
-
-csv_output_fields = ['sgfFile', 'nextMoveColor', 'player', 'playerRank']
+# Each file is split into chunks of this size for parallel processing.
+chunk_bytes = 64 * 1024**2
 
 ################################################
 # variables
@@ -85,85 +89,107 @@ output_format = 'csv'
 
 def main():
     result = {}
-    for k, line in enumerate(sys.stdin):
-        analysis = json.loads(line)
-        add_player_info(analysis)
-        update_result(result, analysis)
-        print_message(k, result, analysis)
+    for path in args['merge']:
+        load_partial(result, path)
+    if args['files']:
+        aggregate_files(result, args['files'], args['jobs'])
+    elif not args['merge']:
+        aggregate_lines(result, sys.stdin.buffer, verbose=True)
+    if args['save_partial']:
+        save_partial(result, args['save_partial'])
     print_result(result)
 
-def add_player_info(d):
-    c = d.get('nextMoveColor')
-    if c == 'B':
-        d.update({'player': d.get('PB'), 'playerRank': d.get('BR')})
-    elif c == 'W':
-        d.update({'player': d.get('PW'), 'playerRank': d.get('WR')})
+def aggregate_lines(result, lines, verbose=False):
+    for k, line in enumerate(lines):
+        if not is_needed(line):
+            continue
+        analysis = json_loads(line)
+        add_player_info(analysis)
+        update_result(result, analysis, by)
+        if verbose:
+            print_message(k, result, analysis)
+
+def is_needed(line):
+    # fast pre-filter before json_loads
+    has_prior = b'"nextMovePrior"' in line or b'"nextMoveHumanPrior"' in line
+    return has_prior and b'"humanSLProfile"' in line
+
+################################################
+# parallel
+
+def aggregate_files(result, paths, jobs):
+    units = list(work_units(paths))
+    if jobs <= 1 or len(units) <= 1:
+        partials = map(aggregate_unit, units)
+        return merge_partials(result, partials, len(units))
+    with Pool(jobs, initializer=set_by, initargs=(by,)) as pool:
+        # imap keeps the order so that the output is the same as sequential one
+        merge_partials(result, pool.imap(aggregate_unit, units), len(units))
+
+def merge_partials(result, partials, total):
+    for k, partial in enumerate(partials):
+        merge_result(result, partial)
+        print_unit_message(k, total, result)
+
+def work_units(paths):
+    # (path, start, end) where lines that start in [start, end) are processed
+    for path in paths:
+        if path.endswith('.gz'):
+            yield (path, 0, None)
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_bytes):
+            yield (path, start, min(start + chunk_bytes, size))
+
+def aggregate_unit(unit):
+    result = {}
+    aggregate_lines(result, lines_in_unit(*unit))
+    return result
 
-def update_result(result, analysis):
-    # ignore analysis after the last move
-    if analysis.get('nextMovePrior') is None and analysis.get('nextMoveHumanPrior') is None:
+def lines_in_unit(path, start, end):
+    if end is None:
+        with gzip.open(path, 'rb') as f:
+            yield from f
         return
-    key = key_of(analysis)
-    record = result.get(key)
-    if record is None:
-        record = new_record(analysis)
-        result[key] = record
-    update_record(record, analysis)
-
-def key_of(analysis):
-    prop = tuple(analysis.get(k) for k in fields_spec[by]['agg'])
-    key = json.dumps(prop)
-    return key
-
-def new_record(analysis):
-    return {
-        **{k: analysis.get(k) for k in fields_spec[by]['out']},
-        'log_likelihood': defaultdict(float),
-        'moves': defaultdict(int),
-    }
-
-def update_record(record, analysis):
-    profile = analysis['humanSLProfile']
-    prior = analysis.get('nextMoveHumanPrior')
-    if prior is None:
-        prior = analysis['nextMovePrior']
-    log_policy = math.log(prior)
-    record['log_likelihood'][profile] += log_policy
-    record['moves'][profile] += 1
+    with open(path, 'rb') as f:
+        if start > 0:
+            # skip the line that starts before "start"
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                return
+            yield line
+
+def set_by(b):
+    global by
+    by = b
+
+################################################
+# partial aggregates (same format as "katawrap.py -reduce-save")
+
+def save_partial(result, path):
+    with open(path, 'w') as f:
+        json.dump(dump_result(result, by), f)
+
+def load_partial(result, path):
+    with open(path) as f:
+        dumped = json.load(f)
+    try:
+        load_result(result, dumped, by)
+    except ValueError as e:
+        raise ValueError(f"{e} in {path}")
+
+################################################
+# output
 
 def print_result(result):
     for record in result.values():
         print_record(record)
 
 def print_record(record):
-    log_likelihood = record['log_likelihood']
-    posterior = get_posterior(log_likelihood)
-    estimated_rank = dict_argmax(log_likelihood)
-    output_fields = fields_spec[by]['out']
-    player_dan = dan_for(record.get('playerRank'))
-    estimated_dan = dan_for(estimated_rank)
-    if output_format == 'json':
-        print(json.dumps({
-            **{k: record.get(k) for k in output_fields},
-            'estimatedRank': estimated_rank,
-            'posteriorOfEstimatedRank': posterior[estimated_rank],
-            'movesForEstimatedRank': record['moves'][estimated_rank],
-            'playerDan': player_dan,
-            'estimatedDan': estimated_dan,
-            'errorOfestimatedDan': estimated_dan - player_dan,
-            'posterior': posterior,
-        }))
-    else:
-        a = [record.get(k) for k in intersection(output_fields, csv_output_fields)]
-        r = [estimated_rank]
-        csv.writer(sys.stdout, delimiter=',').writerow(a + r)
-
-def get_posterior(log_likelihood):
-    # Uniform prior is assumed.
-    m = max(log_likelihood.values())
-    unnormalized_posterior = {k: math.exp(v - m) for k, v in log_likelihood.items()}
-    s = sum(unnormalized_posterior.values())
-    return {k: v / s for k, v in unnormalized_posterior.items()}
+    print(line_for(record, by, output_format))
 
 last_message_count = 0
 def print_message(k, result, analysis):
@@ -180,31 +206,23 @@ def print_message(k, result, analysis):
     pw = analysis.get('PW', '?')
     print(f'...[{ti}] in={count // mega}M, out={len(result)}, PB={pb}, PW={pw}, file={f}', file=sys.stderr)
 
+last_unit_message_time = 0
+def print_unit_message(k, total, result):
+    global last_unit_message_time
+    now = datetime.now().timestamp()
+    done = k + 1 == total
+    if total <= 1 or (now - last_unit_message_time < 10 and not done):
+        return
+    last_unit_message_time = now
+    ti = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f'...[{ti}] chunks={k + 1}/{total}, out={len(result)}', file=sys.stderr)
+
 ################################################
 # util
 
 def find_first(ary, pred, not_found=None):
     return next((x for x in ary if pred(x)), not_found)
 
-def intersection(a, b):
-    # keep order
-    return [x for x in a if x in b]
-
-def dict_argmax(d):
-    return max(d, key=d.get)
-
-def dan_for(rank):
-    nan = float('nan')
-    if rank is None:
-        return nan
-    match = re.search(r'(\d+)([dkp])', rank)
-    if match:
-        n = int(match.group(1))
-        u = match.group(2)
-        return n if u == 'd' else 1 - n if u == 'k' else 9
-    else:
-        return nan
-
 ##############################################
 # run
 
@@ -0,0 +1,352 @@
+# End-to-end tests of katawrap with the fake engine (bench/fake_katago.py).
+#
+# (ex.)
+# python -m pytest -q tests
+
+import gzip
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, '..')
+katawrap = os.path.join(top, 'katawrap', 'katawrap.py')
+merger = os.path.join(top, 'katawrap', 'katawrap_merge.py')
+fake_katago = [sys.executable, os.path.join(top, 'bench', 'fake_katago.py'), '-seed', '3']
+sgf_dir = os.path.join(top, 'sample', 'sgf')
+
+timeout = 60
+
+##############################################
+# util
+
+def sgf_line(name, **fields):
+    return json.dumps({'sgfFile': os.path.join(sgf_dir, name), **fields})
+
+def run(command, input_lines=(), check=True, env=None):
+    proc = subprocess.run(command, input=''.join(line + '\n' for line in input_lines),
+                          capture_output=True, text=True, encoding='utf-8', timeout=timeout,
+                          env=None if env is None else {**os.environ, **env})
+    if check:
+        assert proc.returncode == 0, proc.stderr
+    return proc
+
+def run_katawrap(options, input_lines=(), engine=fake_katago, env=None):
+    return run([sys.executable, katawrap, *options, *engine], input_lines, env=env)
+
+def parse_lines(text):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def turns_of(responses):
+    return [(r['id'], r['turnNumber']) for r in responses]
+
+def error_ids(stderr):
+    return set(re.findall(r"'id': '([^']*)', 'error'", stderr))
+
+# the same game appears three times
+duplicated_input = [
+    sgf_line(name, analyzeTurns=[0, 1, 2])
+    for name in ['sample001.sgf', 'sample001.sgf', 'sample009.sgf', 'sample001.sgf']
+]
+
+##############################################
+# ids
+
+def test_ids_of_duplicated_queries_are_unique():
+    responses = parse_lines(run_katawrap([], duplicated_input).stdout)
+    turns = turns_of(responses)
+    assert len(turns) == 12
+    assert len(set(turns)) == len(turns)
+    assert len({i for i, _ in turns}) == 4
+
+def test_sharded_ids_are_unique_after_merge_and_match_unsharded_run(tmp_path):
+    n = 3
+    paths = []
+    for i in range(n):
+        path = tmp_path / f"shard{i}.jsonl"
+        run_katawrap(['-shard', f"{i}/{n}", '-output', str(path)], duplicated_input)
+        paths.append(str(path))
+    merged = parse_lines(run([sys.executable, merger, *paths]).stdout)
+    unsharded = parse_lines(run_katawrap([], duplicated_input).stdout)
+    assert len(set(turns_of(merged))) == len(merged)
+    digest_and_turn = lambda responses: [(i.split('_')[0], t) for i, t in turns_of(responses)]
+    assert digest_and_turn(merged) == digest_and_turn(unsharded)
+
+def test_ids_do_not_depend_on_line_positions():
+    ids = lambda input_lines: {i for i, _ in turns_of(parse_lines(run_katawrap([], input_lines).stdout))}
+    first, second = duplicated_input[0], duplicated_input[2]
+    assert ids([first, second]) == ids([second, first])
+    assert all('_' not in i for i in ids([first, second]))
+
+@pytest.mark.parametrize('order', ['sort', 'arrival'])
+def test_explicit_id_with_override_list_keeps_all_responses(order):
+    input_lines = [sgf_line('sample001.sgf', id='g1', analyzeTurns=[0, 1])]
+    overrides = json.dumps([{'komi': 6.5}, {'komi': 7.5}])
+    responses = parse_lines(run_katawrap(['-order', order, '-override-list', overrides], input_lines).stdout)
+    assert sorted((r['turnNumber'], r['komi']) for r in responses) == [
+        (0, 6.5), (0, 7.5), (1, 6.5), (1, 7.5)
+    ]
+
+##############################################
+# resume
+
+def test_resume_on_complete_output_exits_without_duplicates(tmp_path):
+    output = tmp_path / 'output.jsonl'
+    run_katawrap(['-resume-output', str(output)], duplicated_input)
+    expected = output.read_text()
+    proc = run_katawrap(['-resume-output', str(output)], duplicated_input)
+    assert 'Found 12 responses' in proc.stderr
+    assert output.read_text() == expected
+
+def test_resume_drops_broken_gzip_tail(tmp_path):
+    output = tmp_path / 'output.jsonl.gz'
+    run_katawrap(['-resume-output', str(output)], duplicated_input[:2])
+    with open(output, 'ab') as f:
+        f.write(b'\x1f\x8b broken member')
+    run_katawrap(['-resume-output', str(output)], duplicated_input)
+    with gzip.open(output, 'rt') as f:
+        turns = turns_of(parse_lines(f.read()))
+    assert len(turns) == 12
+    assert len(set(turns)) == len(turns)
+
+def test_empty_input_exits(tmp_path):
+    assert run_katawrap([], []).stdout == ''
+    assert run_katawrap(['-input-dir', str(tmp_path)]).stdout == ''
+
+##############################################
+# JSON codec
+
+def test_default_output_is_the_same_as_standard_json():
+    for line in run_katawrap([], duplicated_input[:1]).stdout.splitlines():
+        assert line == json.dumps(json.loads(line))
+
+def test_non_ascii_output_does_not_depend_on_locale(tmp_path):
+    pytest.importorskip('orjson')
+    sgf = tmp_path / 'non_ascii.sgf'
+    sgf.write_text('(;GM[1]FF[4]SZ[19]KM[6.5]RU[japanese]PB[\u9ed2]PW[\u767d];B[pd];W[dp])', encoding='utf-8')
+    input_lines = [json.dumps({'sgfFile': str(sgf)})]
+    output = tmp_path / 'output.jsonl'
+    env = {'PYTHONIOENCODING': 'ascii'}
+    stdout = run_katawrap(['-json-codec', 'orjson'], input_lines, env=env).stdout
+    run_katawrap(['-json-codec', 'orjson', '-output', str(output)], input_lines, env=env)
+    for text in [stdout, output.read_text(encoding='utf-8')]:
+        responses = parse_lines(text)
+        assert len(responses) == 3
+        assert all(r['PB'] == '\u9ed2' for r in responses)
+
+##############################################
+# HumanSL rank scan
+
+estimate_rank = os.path.join(top, 'sample', 'estimate_rank.py')
+
+def estimated_ranks(output):
+    lines = parse_lines(run([sys.executable, estimate_rank, '-json'], output.splitlines()).stdout)
+    return {(d['sgfFile'], d['nextMoveColor']): d['estimatedRank'] for d in lines}
+
+@pytest.mark.parametrize('rank', ['5d', '15k'])
+def test_adaptive_rank_scan_gives_the_same_ranks_as_full_scan(rank):
+    input_lines = [sgf_line(name) for name in ['sample001.sgf', 'sample009.sgf']]
+    engine = [*fake_katago, '-humansl-rank', rank]
+    full = run_katawrap(['-scan-humansl-ranks'], input_lines, engine=engine)
+    adaptive = run_katawrap(['-scan-humansl-ranks-adaptively'], input_lines, engine=engine)
+    turns, full_turns = map(int, re.search(r'scan: (\d+) turns .*instead of (\d+) turns', adaptive.stderr).groups())
+    assert full_turns == len(full.stdout.splitlines())
+    assert turns * 3 <= full_turns
+    ranks = estimated_ranks(full.stdout)
+    assert len(ranks) == 4
+    assert estimated_ranks(adaptive.stdout) == ranks
+
+@pytest.mark.parametrize('reduce, script_options', [
+    ('estimate_rank', []),
+    ('estimate_rank:output=json', ['-json']),
+    ('estimate_rank:by=player,output=json', ['-by', 'player', '-json']),
+])
+def test_reduce_gives_the_same_output_as_estimate_rank(reduce, script_options):
+    input_lines = [sgf_line(name, analyzeTurns=list(range(20))) for name in ['sample001.sgf', 'sample009.sgf']]
+    engine = [*fake_katago, '-humansl-rank', '3k']
+    common = ['-scan-humansl-ranks', '-extra', 'excess']
+    responses = run_katawrap(common, input_lines, engine=engine).stdout
+    expected = run([sys.executable, estimate_rank, *script_options], responses.splitlines()).stdout
+    reduced = run_katawrap([*common, '-reduce', reduce], input_lines, engine=engine).stdout
+    assert len(expected.splitlines()) >= 2
+    assert sorted(reduced.splitlines()) == sorted(expected.splitlines())
+
+@pytest.mark.parametrize('reduce', ['no_such_reducer', 'estimate_rank:by=color', 'estimate_rank:json', 'estimate_rank:foo=1'])
+def test_invalid_reduce_is_rejected_without_traceback(reduce):
+    proc = run([sys.executable, katawrap, '-extra', 'excess', '-reduce', reduce, *fake_katago], check=False)
+    assert proc.returncode == 1
+    assert 'Invalid -reduce' in proc.stderr
+    assert 'Traceback' not in proc.stderr
+
+##############################################
+# cost limits
+
+@pytest.mark.parametrize('limits', [
+    ['-max-requests', '1'],
+    ['-max-visits-in-flight', '30'],
+    ['-max-visits-in-flight', '5'],  # smaller than maxVisits of a query
+    ['-auto-limits'],
+    ['-max-buffer-mb', '0.01'],
+])
+@pytest.mark.parametrize('error_rate', ['0', '0.3'])
+def test_limits_do_not_change_output(limits, error_rate):
+    input_lines = [sgf_line(name, analyzeTurns=list(range(8))) for name in ['sample001.sgf', 'sample009.sgf'] * 3]
+    engine = [*fake_katago, '-seed', '5', '-error-rate', error_rate, '-latency', '0.01']
+    unlimited = run_katawrap(['-visits', '10'], input_lines, engine=engine)
+    limited = run_katawrap(['-visits', '10', *limits], input_lines, engine=engine)
+    assert bool(error_ids(limited.stderr)) == (error_rate != '0')
+    assert limited.stdout and limited.stdout == unlimited.stdout
+
+##############################################
+# early stop
+
+early_stop_options = ['-early-stop', '2', '-early-stop-winrate', '0.6', '-early-stop-chunk', '5']
+
+@pytest.mark.parametrize('order', ['sort', 'join', 'arrival'])
+def test_early_stop_finishes_after_error_for_later_chunk(order):
+    # With this seed, errors come after earlier chunks are answered.
+    input_lines = [sgf_line(name) for name in ['sample001.sgf', 'sample009.sgf'] * 10]
+    engine = [*fake_katago, '-seed', '9', '-error-rate', '0.3']
+    proc = run_katawrap(['-order', order, *early_stop_options], input_lines, engine=engine)
+    responses = parse_lines(proc.stdout)
+    turns = [(r['id'], r.get('turnNumber')) for r in responses]
+    assert error_ids(proc.stderr)
+    assert len(set(turns)) == len(turns)
+    if order == 'join':
+        assert not error_ids(proc.stderr) & {r['id'] for r in responses}
+        assert 0 < len(responses) < len(input_lines)
+
+@pytest.mark.parametrize('max_requests', ['1000', '1'])
+@pytest.mark.parametrize('error_rate', ['0', '0.3'])
+def test_early_stop_writes_leading_turns_of_each_game(max_requests, error_rate):
+    input_lines = [sgf_line(name) for name in ['sample001.sgf', 'sample009.sgf']]
+    full = turns_of(parse_lines(run_katawrap([], input_lines).stdout))
+    engine = [*fake_katago, '-seed', '9', '-error-rate', error_rate]
+    proc = run_katawrap(['-max-requests', max_requests, *early_stop_options], input_lines, engine=engine)
+    turns = turns_of(parse_lines(proc.stdout))
+    skipped = int(re.search(r'Early stop: skipped (\d+) turns', proc.stderr).group(1))
+    assert skipped > 0
+    assert bool(error_ids(proc.stderr)) == (error_rate != '0')
+    for i in {i for i, _ in full}:
+        written = [t for j, t in turns if j == i]
+        assert written == list(range(len(written)))
+    if error_rate == '0':
+        assert len(turns) + skipped == len(full)
+
+##############################################
+# two-pass analysis
+
+refine_input = [
+    sgf_line('sample001.sgf', analyzeTurns=list(range(10))),
+    sgf_line('sample009.sgf', analyzeTurns=list(range(10))),
+    sgf_line('sample001.sgf', analyzeTurns=[10, 11, 12]),
+]
+refine_options = ['-order', 'sort', '-extra', 'rich', '-visits', '10', '-refine-visits', '100',
+                  '-refine-winrate-gain', '0.5', '-refine-score-gain', '0']
+
+@pytest.mark.parametrize('error_rate', ['0', '0.3'])
+def test_refined_responses_replace_original_ones(error_rate):
+    expected = turns_of(parse_lines(run_katawrap(['-order', 'sort', '-visits', '10'], refine_input).stdout))
+    engine = [*fake_katago, '-seed', '4', '-error-rate', error_rate]
+    proc = run_katawrap(refine_options, refine_input, engine=engine)
+    responses = parse_lines(proc.stdout)
+    errors = error_ids(proc.stderr)
+    failed_queries = {i for i in errors if ':refine:' not in i}
+    failed_refinements = {(i, int(t)) for i, t in (e.split(':refine:') for e in errors - failed_queries)}
+    refined = {(r['id'], r['turnNumber']) for r in responses if r.get('refined')}
+    assert bool(errors) == (error_rate != '0')
+    assert turns_of(responses) == [(i, t) for i, t in expected if i not in failed_queries]
+    assert 0 < len(refined) < len(responses)
+    assert not refined & failed_refinements
+    assert failed_refinements <= set(turns_of(responses))
+    for r in responses:
+        assert r['rootInfo']['visits'] == (100 if r.get('refined') else 10)
+
+##############################################
+# input
+
+@pytest.mark.parametrize('order', ['sort', 'join', 'arrival'])
+def test_dedup_writes_references_in_output_order(tmp_path, order):
+    with open(os.path.join(sgf_dir, 'sample001.sgf'), 'rb') as f:
+        sgf = f.read()
+    for name in ['a.sgf', 'sub/b.sgf']:
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(sgf)
+    proc = run_katawrap(['-order', order, '-input-dir', str(tmp_path), '-dedup', '-to', '3'])
+    lines = parse_lines(proc.stdout)
+    references = [z for z in lines if 'duplicateOf' in z]
+    assert len(references) == 1
+    assert references[0]['sgfFile'] != references[0]['duplicateOf']
+    assert len(lines) == (2 if order == 'join' else 5)
+    if order != 'arrival':
+        # the first copy is found first in either order of the walk
+        assert lines[-1] == references[0]
+
+@pytest.mark.parametrize('option', ['-input', '-input-archive', '-input-dir'])
+def test_missing_input_path_is_rejected_without_traceback(tmp_path, option):
+    path = str(tmp_path / 'missing.zip')
+    proc = run([sys.executable, katawrap, option, path, *fake_katago], check=False)
+    assert proc.returncode == 1
+    assert 'No such file or directory' in proc.stderr
+    assert 'Traceback' not in proc.stderr
+
+def make_archive(path, members):
+    # members: {name: path of file}
+    if path.suffix == '.zip':
+        import zipfile
+        with zipfile.ZipFile(path, 'w') as z:
+            for name, file in members.items():
+                z.write(file, name)
+    else:
+        import tarfile
+        with tarfile.open(path, 'w:gz') as t:
+            for name, file in members.items():
+                t.add(file, name)
+
+@pytest.mark.parametrize('suffix', ['.zip', '.tar.gz'])
+@pytest.mark.parametrize('error_rate', ['0', '0.5'])
+def test_input_archive_gives_the_same_turns_as_plain_files(tmp_path, suffix, error_rate):
+    names = ['sample001.sgf', 'sample009.sgf']
+    path = tmp_path / f"games{suffix}"
+    members = {f"games/{name}": os.path.join(sgf_dir, name) for name in names}
+    make_archive(path, {**members, 'games/readme.txt': os.path.join(top, 'README.md')})
+    engine = [*fake_katago, '-seed', '8', '-error-rate', error_rate]
+    plain = parse_lines(run_katawrap(['-to', '5'], [sgf_line(name) for name in names], engine=engine).stdout)
+    proc = run_katawrap(['-input-archive', str(path), '-to', '5'], engine=engine)
+    responses = parse_lines(proc.stdout)
+    member_lines = [json.dumps({'sgfFile': f"{path}!{name}"}) for name in members]
+    from_stdin = parse_lines(run_katawrap(['-to', '5'], member_lines, engine=engine).stdout)
+    assert bool(error_ids(proc.stderr)) == (error_rate != '0')
+    assert responses and turns_of(responses) == turns_of(plain)
+    assert {r['sgfFile'] for r in responses} <= {f"{path}!{name}" for name in members}
+    assert from_stdin == responses
+
+@pytest.mark.parametrize('error_rate', ['0', '0.5'])
+def test_split_sgf_collections_ignores_parentheses_in_junk_text(tmp_path, error_rate):
+    sys.path.append(os.path.join(top, 'katawrap'))
+    import sgf_collection
+    games = []
+    for name in ['sample001.sgf', 'sample009.sgf', 'sample001.sgf']:
+        with open(os.path.join(sgf_dir, name), 'rb') as f:
+            games.append(f.read().strip())
+    collection = tmp_path / 'collection.sgf'
+    collection.write_bytes(b'Games (3 of them) :-(\n' + b'\n(not a game)\n'.join(games) + b'\n(end')
+    with open(collection, 'rb') as f:
+        count = sgf_collection.count_games(f)
+    engine = [*fake_katago, '-seed', '8', '-error-rate', error_rate]
+    proc = run_katawrap(['-split-sgf-collections', '-to', '3'], [json.dumps({'sgfFile': str(collection)})], engine=engine)
+    responses = parse_lines(proc.stdout)
+    errors = error_ids(proc.stderr)
+    indices = sorted({r['gameIndex'] for r in responses})
+    assert count == 3
+    assert bool(errors) == (error_rate != '0')
+    assert indices and len(indices) == count - len(errors)
+    assert set(indices) <= set(range(count))
+    for k in indices:
+        assert [r['turnNumber'] for r in responses if r['gameIndex'] == k] == [0, 1, 2, 3]
+    assert 'Failed' not in proc.stderr
@@ -0,0 +1,94 @@
+# Unit tests of Sorter (katawrap/sorter.py).
+
+import os
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+from sorter import Sorter
+
+def requests_for(i, turns):
+    return [{'id': i, 'turnNumber': t} for t in turns]
+
+def turns_of(pairs):
+    return [(req['id'], res['turnNumber']) for req, res in pairs]
+
+def test_responses_are_sorted_by_requests():
+    sorter = Sorter(sort=True)
+    sorter.push_requests(requests_for('a', [0, 1]) + requests_for('b', [0]))
+    assert sorter.push_response({'id': 'b', 'turnNumber': 0}) == []
+    assert sorter.push_response({'id': 'a', 'turnNumber': 1}) == []
+    pairs = sorter.push_response({'id': 'a', 'turnNumber': 0})
+    assert turns_of(pairs) == [('a', 0), ('a', 1), ('b', 0)]
+    assert not sorter.has_requests()
+
+def test_responses_are_released_on_arrival():
+    sorter = Sorter(sort=False)
+    sorter.push_requests(requests_for('a', [0, 1]))
+    assert turns_of(sorter.push_response({'id': 'a', 'turnNumber': 1})) == [('a', 1)]
+    assert sorter.get_request_for({'id': 'a', 'turnNumber': 1}) is None
+    assert sorter.get_request_for({'id': 'a', 'turnNumber': 0}) == {'id': 'a', 'turnNumber': 0}
+
+def test_unmatched_response_is_reported():
+    errors = []
+    sorter = Sorter(sort=False, error_reporter=errors.append)
+    sorter.push_requests(requests_for('a', [0]))
+    assert sorter.push_response({'id': 'x', 'turnNumber': 0}) == []
+    assert len(errors) == 1
+    assert sorter.count()[0] == 1
+
+@pytest.mark.parametrize('sort', [True, False])
+def test_duplicated_requests_are_answered_in_order(sort):
+    sorter = Sorter(sort=sort)
+    sorter.push_requests(requests_for('a', [0, 1]) + requests_for('a', [0, 1]))
+    first = {'id': 'a', 'turnNumber': 0, 'komi': 6.5}
+    second = {'id': 'a', 'turnNumber': 0, 'komi': 7.5}
+    pairs = sorter.push_response(first) + sorter.push_response(second)
+    pairs += sorter.push_response({'id': 'a', 'turnNumber': 1})
+    pairs += sorter.push_response({'id': 'a', 'turnNumber': 1})
+    assert len(pairs) == 4
+    assert len({id(req) for req, _ in pairs}) == 4
+    assert [res.get('komi') for _, res in pairs if res['turnNumber'] == 0] == [6.5, 7.5]
+    assert not sorter.has_requests()
+
+def test_pop_requests_by_id():
+    sorter = Sorter(sort=True)
+    sorter.push_requests(requests_for('a', [0, 1, 2]) + requests_for('b', [0]))
+    popped = sorter.pop_requests_by_id('a', turns=[1, 2])
+    assert [req['turnNumber'] for req in popped] == [1, 2]
+    assert turns_of(sorter.push_response({'id': 'a', 'turnNumber': 0})) == [('a', 0)]
+    assert turns_of(sorter.push_response({'id': 'b', 'turnNumber': 0})) == [('b', 0)]
+
+def test_dump_and_undump():
+    sorter = Sorter(sort=True)
+    sorter.push_requests(requests_for('a', [0, 1]))
+    restored = Sorter(sort=True)
+    restored.undump_requests(sorter.dump_requests())
+    pairs = restored.push_response({'id': 'a', 'turnNumber': 0})
+    assert turns_of(pairs) == [('a', 0)]
+    assert restored.has_requests()
+
+def test_giving_up_drops_pooled_responses_and_releases_later_pairs():
+    sorter = Sorter(sort=True)
+    sorter.push_requests(requests_for('a', [0, 1]) + requests_for('b', [0]))
+    assert sorter.push_response({'id': 'a', 'turnNumber': 1}) == []
+    assert sorter.push_response({'id': 'b', 'turnNumber': 0}) == []
+    sorter.pop_requests_by_id('a')
+    assert turns_of(sorter.pop_pairs()) == [('b', 0)]
+    assert sorter.count()[:2] == (0, 0)
+    assert not sorter.has_requests()
+
+def test_unsent_requests_are_not_pending_work():
+    sorter = Sorter(sort=True, max_requests=2, work_of=lambda req: 10)
+    unsent = lambda req: req['turnNumber'] >= 1
+    sorter.push_requests(requests_for('a', [0, 1, 2, 3]), is_unsent=unsent)
+    assert sorter.cost()[0] == 10
+    assert sorter.has_room()
+    sorter.mark_sent_by_id('a', {1, 2})
+    assert sorter.cost()[0] == 30
+    assert not sorter.has_room()
+    sorter.pop_requests_by_id('a', turns={3})
+    assert sorter.cost()[0] == 30
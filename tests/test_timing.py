@@ -0,0 +1,25 @@
+# Unit tests of stage timers (katawrap/timing.py).
+
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'katawrap'))
+
+from timing import Timers, NullTimers
+
+def test_timers_record_each_stage():
+    timers = Timers()
+    with timers.timed('a'):
+        pass
+    timers.decorate('b')(lambda: None)()
+    lines = timers.summary().splitlines()
+    assert [line.split()[:2] for line in lines[1:]] in ([['a', '1'], ['b', '1']], [['b', '1'], ['a', '1']])
+
+def test_null_timers_do_nothing():
+    timers = NullTimers()
+    func = lambda: 3
+    assert timers.decorate('a')(func) is func
+    with timers.timed('b'):
+        pass
+    assert timers.summary() == ''